@@ -0,0 +1,378 @@
+'''
+Benchmark for the data layer, runs without a display. Generates synthetic
+calendars spread over a number of years, then times the Event queries, saves,
+the iCalendar importer and the processing of Google Calendar items against a
+local fake of the API. The results are written as JSON, so that releases can
+be compared.
+
+    python benchmarks/data_layer.py > results.json
+    python benchmarks/data_layer.py --sizes 1000 50000 --output results.json
+
+Generating the largest calendar takes a while, pass --directory to keep the
+generated databases and reuse them on the next run. Every run works on a copy,
+so the databases stay the same.
+'''
+from datetime import date, datetime, timedelta
+
+import multiprocessing
+import subprocess
+import platform
+import argparse
+import tempfile
+import sqlite3
+import random
+import shutil
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ics_import import write_file
+from event import Event
+
+import importer
+
+
+# First day of the synthetic calendars
+START_DATE = date(2010, 1, 1)
+
+# Events are written in batches of this size while generating
+BATCH_SIZE = 10000
+
+
+class FakeService(object):
+    '''
+    Stands in for the Google Calendar service, only answers the events list
+    that Event.import_google makes
+    '''
+    def __init__(self, items):
+        '''
+        :param items: Event resources to return
+        :type items: list[dict]
+        '''
+        self.items = items
+
+    def events(self):
+        return self
+
+    def list(self, calendarId):
+        return self
+
+    def execute(self):
+        return {'items': self.items}
+
+
+def make_event(generator, day, i):
+    '''
+    Create a synthetic event of up to three hours. One in a hundred repeats
+    weekly for a year and one in ten has a Google id.
+
+    :param generator: Random number generator
+    :type generator: random.Random
+
+    :param day: Day the event starts on
+    :type day: date
+
+    :param i: Number of the event
+    :type i: int
+
+    :returns Event: Unsaved Event
+    '''
+    start = datetime(day.year, day.month, day.day, generator.randint(0, 20))
+    event = Event()
+    event.name = 'Event {}'.format(i)
+    event.location = 'Room {}'.format(i % 50)
+    event.set_start(start)
+    event.set_end(start + timedelta(hours=generator.randint(1, 3)))
+    if i % 100 == 0:
+        event.set_rrule('RRULE:FREQ=WEEKLY;COUNT=52')
+    if i % 10 == 0:
+        event.google_id = 'google-{}'.format(i)
+    return event
+
+
+def close():
+    '''
+    Close the connection of this thread, which also checkpoints the WAL so
+    the database is a single file again
+    '''
+    if Event.is_connected:
+        Event.get_connection().close()
+        Event.is_connected = False
+
+
+def use_database(directory):
+    '''
+    Point Event at the events.db in a directory
+
+    :param directory: Directory
+    :type directory: str
+    '''
+    close()
+    Event.CONFIG_DIR = directory
+    Event.connect()
+
+
+def generate(directory, count, days, seed):
+    '''
+    Write a synthetic events.db, unless the directory already has one
+
+    :param directory: Directory to write the database to
+    :type directory: str
+
+    :param count: Number of events
+    :type count: int
+
+    :param days: Number of days to spread the events over
+    :type days: int
+
+    :param seed: Seed of the random number generator
+    :type seed: int
+    '''
+    if os.path.exists(os.path.join(directory, 'events.db')):
+        return
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    began = time.time()
+    use_database(directory)
+    generator = random.Random(seed)
+    for first in range(0, count, BATCH_SIZE):
+        Event.save_many([
+            make_event(
+                generator,
+                START_DATE + timedelta(generator.randrange(days)),
+                i
+            )
+            for i in range(first, min(first + BATCH_SIZE, count))
+        ])
+    close()
+    log('generated {} events in {:.1f}s'.format(count, time.time() - began))
+
+
+def log(message):
+    sys.stderr.write(message + '\n')
+
+
+def measure(function, calls, before=None):
+    '''
+    Time a function
+
+    :param function: Function to time
+    :type function: callable
+
+    :param calls: Arguments to call the function with, one tuple per call
+    :type calls: list[tuple]
+
+    :param before: Called before every call, not part of the time
+    :type before: callable
+
+    :returns dict: Number of calls and the total, mean, median, min and max
+        time per call in milliseconds
+    '''
+    times = []
+    for args in calls:
+        if before is not None:
+            before()
+        began = time.time()
+        function(*args)
+        times.append((time.time() - began) * 1000)
+    times.sort()
+    return {
+        'calls': len(times),
+        'total_ms': sum(times),
+        'mean_ms': sum(times) / len(times),
+        'median_ms': times[len(times) // 2],
+        'min_ms': times[0],
+        'max_ms': times[-1],
+    }
+
+
+def clear_caches():
+    Event.cache.clear()
+    Event.recurrences.clear()
+
+
+def benchmark(directory, count, days, args):
+    '''
+    Run all benchmarks against the database in a directory
+
+    :param directory: Directory of a database from generate, which is
+        changed by the saves and imports
+    :type directory: str
+
+    :param count: Number of events in the database
+    :type count: int
+
+    :param days: Number of days the events are spread over
+    :type days: int
+
+    :param args: Command line arguments
+    :type args: argparse.Namespace
+
+    :returns dict: Results per benchmark, see measure
+    '''
+    use_database(directory)
+    generator = random.Random(args.seed)
+    results = {}
+
+    lookups = [
+        START_DATE + timedelta(generator.randrange(days))
+        for i in range(args.lookups)
+    ]
+    by_day = [(day.year, day.month, day.day) for day in lookups]
+    results['get_by_day'] = measure(Event.get_by_day, by_day, clear_caches)
+    # The cache only keeps the last day after the cold run
+    for values in by_day:
+        Event.get_by_day(*values)
+    results['get_by_day_cached'] = measure(Event.get_by_day, by_day)
+    by_hour = [values + (generator.randint(0, 23),) for values in by_day]
+    results['get_by_hour'] = measure(Event.get_by_hour, by_hour, clear_caches)
+    log('  {} events: lookups done'.format(count))
+
+    results['get_all'] = measure(
+        Event.get_all,
+        [()] * args.runs,
+        clear_caches
+    )
+    log('  {} events: get_all done'.format(count))
+
+    new = [
+        make_event(generator, lookups[i % len(lookups)], count + i)
+        for i in range(args.saves)
+    ]
+    for event in new:
+        event.google_id = ''
+    results['save_new'] = measure(Event.save, [(event,) for event in new])
+    existing = [
+        Event.get_by_id(generator.randint(1, count))
+        for i in range(args.saves)
+    ]
+    for event in existing:
+        event.name = event.name + ' changed'
+    results['save_existing'] = measure(
+        Event.save,
+        [(event,) for event in existing]
+    )
+    log('  {} events: saves done'.format(count))
+
+    path = os.path.join(directory, 'import.ics')
+    write_file(path, args.imports)
+    results['import_file'] = measure(importer.import_file, [(path,)])
+    results['import_file_unchanged'] = measure(importer.import_file, [(path,)])
+    results['import_file']['events'] = args.imports
+    results['import_file_unchanged']['events'] = args.imports
+    log('  {} events: import done'.format(count))
+
+    # Half of the items were synced before, the others are new
+    items = []
+    for i in range(args.items):
+        day = lookups[i % len(lookups)]
+        start = datetime.combine(day, datetime.min.time()) + timedelta(
+            hours=generator.randint(0, 20)
+        )
+        items.append({
+            'id': 'google-{}'.format(
+                generator.randrange(0, count, 10) if i % 2 else count + i
+            ),
+            'summary': 'Item {}'.format(i),
+            'location': 'Room {}'.format(i % 50),
+            'start': {'dateTime': start.strftime('%Y-%m-%dT%H:%M:%S+02:00')},
+            'end': {'dateTime': (start + timedelta(hours=1)).strftime(
+                '%Y-%m-%dT%H:%M:%S+02:00'
+            )},
+        })
+    results['google_import_events'] = measure(
+        Event.import_google,
+        [(FakeService(items), 'benchmark')]
+    )
+    results['google_import_events']['events'] = args.items
+    log('  {} events: google done'.format(count))
+
+    close()
+    return results
+
+
+def get_revision():
+    '''
+    Get the git commit that is benchmarked
+
+    :returns str|None: Commit hash, None outside of a git checkout
+    '''
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'],
+                cwd=ROOT,
+                stderr=devnull
+            ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    arg_parser.add_argument(
+        '--sizes',
+        type=int,
+        nargs='+',
+        default=[1000, 50000, 500000]
+    )
+    arg_parser.add_argument('--years', type=int, default=10)
+    arg_parser.add_argument('--lookups', type=int, default=50)
+    arg_parser.add_argument('--runs', type=int, default=3)
+    arg_parser.add_argument('--saves', type=int, default=100)
+    arg_parser.add_argument('--imports', type=int, default=1000)
+    arg_parser.add_argument('--items', type=int, default=250)
+    arg_parser.add_argument('--seed', type=int, default=1)
+    arg_parser.add_argument('--directory')
+    arg_parser.add_argument('--output', default='-')
+    args = arg_parser.parse_args()
+
+    days = (START_DATE.replace(year=START_DATE.year + args.years) -
+            START_DATE).days
+    directory = args.directory or tempfile.mkdtemp()
+    results = {
+        'revision': get_revision(),
+        'started': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': multiprocessing.cpu_count(),
+        'years': args.years,
+        'sizes': {},
+    }
+    try:
+        for count in args.sizes:
+            calendar = os.path.join(directory, 'events-{}'.format(count))
+            generate(calendar, count, days, args.seed)
+            run = tempfile.mkdtemp()
+            try:
+                shutil.copy(os.path.join(calendar, 'events.db'), run)
+                results['sizes'][str(count)] = benchmark(
+                    run,
+                    count,
+                    days,
+                    args
+                )
+            finally:
+                shutil.rmtree(run)
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == '-':
+        print output
+    else:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+'''
+Benchmark for importing a large iCalendar file. Writes a synthetic file,
+then reports the time and peak memory of reading it with the streaming
+importer and of saving it to a fresh database.
+
+    python benchmarks/ics_import.py --events 1000000
+
+With --files the events are split over several files, which are parsed by
+a pool of one and of --processes processes before being imported.
+
+    python benchmarks/ics_import.py --events 100000 --files 24
+'''
+from datetime import datetime, timedelta
+
+import multiprocessing
+import argparse
+import resource
+import shutil
+import tempfile
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__
+))))
+
+from event import Event
+
+import importer
+
+
+def write_file(path, count):
+    '''
+    Write an iCalendar file with a number of one hour events, one recurring
+    event per hundred
+
+    :param path: Path
+    :type path: str
+
+    :param count: Number of events
+    :type count: int
+    '''
+    start = datetime(2010, 1, 1, 8)
+    with open(path, 'w') as ics_file:
+        ics_file.write('BEGIN:VCALENDAR\r\nVERSION:2.0\r\n')
+        for i in range(count):
+            moment = start + timedelta(hours=3 * i)
+            lines = [
+                'BEGIN:VEVENT',
+                'UID:event-{}@benchmark'.format(i),
+                'SUMMARY:Event {}'.format(i),
+                'LOCATION:Room {}'.format(i % 50),
+                'DTSTART:' + moment.strftime('%Y%m%dT%H%M%SZ'),
+                'DTEND:' + (moment + timedelta(hours=1)).strftime(
+                    '%Y%m%dT%H%M%SZ'
+                ),
+            ]
+            if i % 100 == 0:
+                lines.append('RRULE:FREQ=WEEKLY;COUNT=10')
+            lines.append('END:VEVENT')
+            ics_file.write('\r\n'.join(lines) + '\r\n')
+        ics_file.write('END:VCALENDAR\r\n')
+
+
+def peak_memory():
+    '''
+    Get the peak resident memory of the process so far
+
+    :returns float: Megabytes
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def report(label, count, seconds):
+    print '{:<8} {:>9} events {:>8.1f}s {:>9.0f} events/s {:>7.1f} MB'.format(
+        label,
+        count,
+        seconds,
+        count / max(seconds, 0.001),
+        peak_memory()
+    )
+
+
+def benchmark_files(directory, events, files, processes):
+    '''
+    Benchmark parsing and importing several files in parallel
+
+    :param directory: Directory to write the files and database to
+    :type directory: str
+
+    :param events: Total number of events
+    :type events: int
+
+    :param files: Number of files
+    :type files: int
+
+    :param processes: Number of processes to compare with one
+    :type processes: int
+    '''
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, 'events-{}.ics'.format(i))
+        write_file(path, events // files)
+        paths.append(path)
+
+    for count in sorted(set([1, processes])):
+        began = time.time()
+        total = sum(
+            len(events) for path, events, seconds
+            in importer.parse_files(paths, count)
+        )
+        report('parse/{}'.format(count), total, time.time() - began)
+
+    def parsed(path, count, seconds):
+        print '  {}: {} events in {:.2f}s'.format(
+            os.path.basename(path),
+            count,
+            seconds
+        )
+
+    Event.CONFIG_DIR = directory
+    began = time.time()
+    count = sum(importer.import_files([directory], processes, parsed))
+    report('import', count, time.time() - began)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--events', type=int, default=1000000)
+    arg_parser.add_argument('--files', type=int, default=0)
+    arg_parser.add_argument(
+        '--processes',
+        type=int,
+        default=multiprocessing.cpu_count()
+    )
+    args = arg_parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        if args.files:
+            benchmark_files(directory, args.events, args.files, args.processes)
+            return
+        path = os.path.join(directory, 'events.ics')
+        began = time.time()
+        write_file(path, args.events)
+        size = os.path.getsize(path) / 1024.0 / 1024.0
+        print 'Wrote {:.0f} MB in {:.1f}s'.format(size, time.time() - began)
+
+        began = time.time()
+        with open(path) as ics_file:
+            count = sum(1 for event in importer.read_events(ics_file))
+        report('parse', count, time.time() - began)
+
+        Event.CONFIG_DIR = directory
+        began = time.time()
+        with open(path) as ics_file:
+            count = sum(importer.import_events(importer.read_events(ics_file)))
+        report('import', count, time.time() - began)
+
+        # Nothing changed, so only the journal shows writes to events
+        seq = Event.get_last_seq()
+        began = time.time()
+        imported = importer.import_file(path)
+        report('reimport', sum(imported), time.time() - began)
+        print '{} unchanged, {} rows written'.format(
+            imported.unchanged,
+            Event.get_last_seq() - seq
+        )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+'''
+Measures how long it takes to load the window and the command line, in
+fresh interpreters, and checks that the slow optional dependencies are not
+imported on the way. Exits with 1 if one of them is, so it can guard
+startup time in a build.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --window
+
+With --window the window is also opened, and the time until it is first
+drawn is measured. That needs a display.
+'''
+import subprocess
+import argparse
+import json
+import sys
+import os
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed for syncing, importing and exporting
+DEFERRED = (
+    'apiclient',
+    'oauth2client',
+    'httplib2',
+    'icalendar',
+    'dateutil',
+)
+
+MEASURE = '''
+import time
+began = time.time()
+import {module}
+loaded = time.time() - began
+{window}
+import json, sys
+print json.dumps({{
+    'seconds': loaded,
+    'drawn': drawn,
+    'modules': sorted(set(name.split('.')[0] for name in sys.modules)),
+}})
+'''
+
+WINDOW = '''
+from gi.repository import Gtk, GLib
+window = cal.CalendarWindow()
+drawn = []
+def on_draw(*args):
+    if not drawn:
+        drawn.append(time.time() - began)
+        GLib.idle_add(Gtk.main_quit)
+window.connect('draw', on_draw)
+Gtk.main()
+drawn = drawn[0]
+'''
+
+
+def measure(module, window=False):
+    '''
+    Import a module in a fresh interpreter
+
+    :param module: Name of the module
+    :type module: str
+
+    :param window: Whether to open the window after importing cal
+    :type window: bool
+
+    :returns dict: Seconds the import took, seconds until the window was
+        first drawn and the top level modules that were loaded
+    '''
+    code = MEASURE.format(
+        module=module,
+        window=WINDOW if window else 'drawn = None'
+    )
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--window', action='store_true')
+    arg_parser.add_argument('--runs', type=int, default=5)
+    args = arg_parser.parse_args()
+
+    failed = False
+    for module in ('cli', 'cal'):
+        runs = [
+            measure(module, args.window and module == 'cal')
+            for i in range(args.runs)
+        ]
+        seconds = min(run['seconds'] for run in runs)
+        print '{:<4} import {:>7.1f}ms'.format(module, seconds * 1000),
+        if runs[0]['drawn'] is not None:
+            drawn = min(run['drawn'] for run in runs)
+            print '  first draw {:>7.1f}ms'.format(drawn * 1000),
+        print
+        loaded = [name for name in DEFERRED if name in runs[0]['modules']]
+        if loaded:
+            print '  loaded at startup: ' + ', '.join(loaded)
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
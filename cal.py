@@ -1,22 +1,64 @@
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 from datetime import date, timedelta, datetime
-from dateutil import parser
-from icalendar import Calendar
-from apiclient import discovery
-from oauth2client import file
-from oauth2client import client
-from oauth2client import tools
 from event import Event
+from worker import DatabaseWorker
 from config import Config
+from profiler import Profiler, span
 
+import recurrence
 import gui
-import time
 import sys
 import getopt
-import argparse
-import httplib2
+import time
 import os
 
+# The Google client, dateutil's parser and icalendar (through importer and
+# exporter) are slow to import and only needed for syncing, importing and
+# exporting, so they are imported when first used.
+# benchmarks/startup.py checks that they stay off the startup path.
+
+
+def on_main_thread(callback):
+    '''
+    Wrap a callback so that it runs on the GTK main loop, whichever thread
+    calls it. Events can be saved by the database worker, so the views
+    subscribe to changes through this.
+
+    :param callback: Callback
+    :type callback: callable
+
+    :returns callable: Wrapped callback
+    '''
+    def deliver(*args):
+        GLib.idle_add(lambda: callback(*args) and False)
+    return deliver
+
+
+def get_changed_starts(notices, limit=50):
+    '''
+    Get the old and new starts of the events in a list of Notices, so that
+    views can redraw only the affected cells.
+
+    :param notices: Notices from Event.subscribe
+    :type notices: list[Notice]
+
+    :param limit: Maximum number of starts worth redrawing separately
+    :type limit: int
+
+    :returns list[datetime]|None: Starts, None if the whole view should be
+        redrawn because a recurring event changed or too much changed
+    '''
+    starts = set()
+    for notice in notices:
+        if notice.is_recurring:
+            return None
+        for start in (notice.old_start, notice.new_start):
+            if start is not None:
+                starts.add(start)
+    if len(starts) > limit:
+        return None
+    return list(starts)
+
 
 class Week:
     def __init__(self, date):
@@ -188,7 +230,80 @@ class SettingsEditor:
         self.parent.toggle_google_button()
 
 
+class EventSearch(Gtk.SearchEntry):
+    LIMIT = 20
+
+    def __init__(self, parent):
+        '''
+        Creates a search field that lists matching events below it while the
+        user types. Clicking a result opens it for editing.
+
+        :param parent: Parent window
+        :type parent: CalendarWindow
+        '''
+        Gtk.SearchEntry.__init__(self)
+        self.parent = parent
+        self.set_placeholder_text('Search events')
+
+        self.results = Gtk.ListBox()
+        self.results.connect('row-activated', self.result_click)
+        self.popover = Gtk.Popover(relative_to=self, modal=False)
+        self.popover.add(self.results)
+
+        self.connect('search-changed', self.search)
+        self.connect('stop-search', self.close)
+
+    def search(self, *args):
+        '''
+        Look up the events matching the current text on the database worker
+        '''
+        text = self.get_text()
+        self.parent.worker.search(
+            text,
+            self.LIMIT,
+            lambda future: self.results_loaded(future, text)
+        )
+
+    def results_loaded(self, future, text):
+        '''
+        Replace the results with the events the database worker found
+
+        :param future: Result of DatabaseWorker.search
+        :type future: Future
+
+        :param text: Text that was searched for
+        :type text: str
+        '''
+        # Skip results for text the user has typed on from
+        if text != self.get_text():
+            return
+        [row.destroy() for row in self.results]
+        events = future.result()
+        if not events:
+            self.popover.hide()
+            return
+        for event in events:
+            text = event.get_start().strftime('%Y-%m-%d %H:%M') + '  ' + \
+                event.name
+            row = Gtk.ListBoxRow()
+            row.add(gui.LeftLabel(text))
+            row.event = event
+            self.results.add(row)
+        self.popover.show_all()
+
+    def result_click(self, listbox, row):
+        self.close()
+        EventEditor(row.event, CalendarEvent(self.parent.current_view))
+
+    def close(self, *args):
+        self.popover.hide()
+
+
 class EventEditor:
+    # Responses of the dialog asking what a change to a series is for
+    OCCURRENCE = 1
+    SERIES = 2
+
     def __init__(self, event, initiator):
         '''
         Creates an Event edit window
@@ -271,9 +386,25 @@ class EventEditor:
         self.location_entry.set_text(self.event.location)
         grid.attach(self.location_entry, 1, 4, 1, 1)
 
+        # Overlapping events
+        self.conflict_label = gui.LeftLabel()
+        grid.attach(self.conflict_label, 1, 5, 1, 1)
+        self.date_entry.connect('changed', self.check_conflicts)
+        self.start_hour_dropdown.connect('changed', self.check_conflicts)
+        self.start_minute_dropdown.connect('changed', self.check_conflicts)
+        self.end_hour_dropdown.connect('changed', self.check_conflicts)
+        self.end_minute_dropdown.connect('changed', self.check_conflicts)
+        self.check_conflicts()
+
         # Button box
         buttons = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
 
+        # Delete button
+        if self.event.is_saved:
+            button = Gtk.Button('Delete')
+            button.connect('clicked', self.delete)
+            buttons.pack_start(button, False, True, 0)
+
         # Filler
         buttons.pack_start(Gtk.Label(), True, True, 10)
 
@@ -283,9 +414,9 @@ class EventEditor:
         buttons.pack_start(button, False, True, 10)
 
         # Save button
-        button = Gtk.Button('Save')
-        button.connect('clicked', self.save)
-        buttons.pack_start(button, False, True, 0)
+        self.save_button = Gtk.Button('Save')
+        self.save_button.connect('clicked', self.save)
+        buttons.pack_start(self.save_button, False, True, 0)
 
         # Put everything together and show the window
         app_container.pack_start(grid, True, True, 10)
@@ -294,11 +425,86 @@ class EventEditor:
 
         self.window.show_all()
 
+    def get_times(self):
+        '''
+        Get the start and end entered in the form
+
+        :returns tuple: Start and end as datetimes
+        '''
+        day = datetime.strptime(self.date_entry.get_text(), '%Y-%m-%d')
+        start = day + timedelta(
+            hours=self.start_hour_dropdown.get_value(),
+            minutes=self.start_minute_dropdown.get_value()
+        )
+        end = day + timedelta(
+            hours=self.end_hour_dropdown.get_value(),
+            minutes=self.end_minute_dropdown.get_value()
+        )
+        if end < start:
+            end = end + timedelta(1)
+        return start, end
+
+    def check_conflicts(self, *args):
+        '''
+        Load the events around the times in the form on the database worker
+        to show which of them overlap
+        '''
+        try:
+            start, end = self.get_times()
+        except ValueError:
+            # The date is being typed
+            self.conflict_label.set_text('')
+            return
+        # Events of the day before can run past midnight into this one
+        self.initiator.parent.parent.worker.get_range(
+            start.date() - timedelta(1),
+            end.date(),
+            lambda future: self.conflicts_loaded(future, start, end)
+        )
+
+    def conflicts_loaded(self, future, start, end):
+        '''
+        Show which other events overlap the times in the form
+
+        :param future: Result of DatabaseWorker.get_range
+        :type future: Future
+
+        :param start: Start that was entered when the events were requested
+        :type start: datetime
+
+        :param end: End that was entered when the events were requested
+        :type end: datetime
+        '''
+        # Skip times the user has already changed
+        try:
+            if self.get_times() != (start, end):
+                return
+        except ValueError:
+            return
+        index = Event.build_index(sum(future.result().values(), []))
+        conflicts = [other.name for other in index.overlapping(start, end)
+                     if other.id != self.event.id]
+        if conflicts:
+            self.conflict_label.set_text(
+                'Overlaps with: ' + ', '.join(conflicts)
+            )
+        else:
+            self.conflict_label.set_text('')
+
     def save(self, *args):
         '''
-        Saves the event and closes the window
+        Saves the event on the database worker. The form is applied to a
+        copy, so that the event the views show only changes once the save
+        succeeded, the window closes then.
         '''
-        event = self.event
+        event = self.event.copy()
+        series = None
+        if self.event.rrule:
+            response = self.ask_series()
+            if response == self.OCCURRENCE:
+                series, event = self.event.split()
+            elif response != self.SERIES:
+                return
         event.name = self.name_entry.get_text()
         event.location = self.location_entry.get_text()
         date = self.date_entry.get_text()
@@ -310,25 +516,139 @@ class EventEditor:
         event.end_hour = self.end_hour_dropdown.get_value()
         event.end_minute = self.end_minute_dropdown.get_value()
 
+        # Moving a series moves the occurrences it leaves out and its end
+        delta = event.get_start() - self.event.get_start()
+        if event.rrule and delta:
+            event.rrule = recurrence.shift(event.rrule, delta)
+
         if self.initiator.parent.parent.config.get('google_sync'):
             google = self.initiator.parent.parent.get_google_client()
             google.set_calendar_id()
             google.export_event(event)
 
-        event.save()
+        # The views redraw the affected cells through Event.subscribe
+        self.save_button.set_sensitive(False)
+        worker = self.initiator.parent.parent.worker
+        if series is None:
+            worker.save(event, self.saved)
+        else:
+            worker.save_many([series, event], self.saved)
 
-        self.initiator.add_event(event)
-        self.initiator.refresh_events()
-        # Give the click event back to the Initiator
-        self.initiator.is_blocked = False
-        self.initiator.parent.update_gui()
+    def ask_series(self):
+        '''
+        Ask whether a change to a recurring event is meant for the
+        occurrence that was opened or for the whole series
+
+        :returns int: OCCURRENCE, SERIES or another response if cancelled
+        '''
+        dialog = Gtk.MessageDialog(
+            transient_for=self.window,
+            modal=True,
+            message_type=Gtk.MessageType.QUESTION,
+            buttons=Gtk.ButtonsType.NONE,
+            text='Change the series "{}"?'.format(self.event.name)
+        )
+        dialog.format_secondary_text(
+            'This is a recurring event, the change can be made to this '
+            'occurrence only or to all of its occurrences.'
+        )
+        dialog.add_buttons(
+            'Cancel',
+            Gtk.ResponseType.CANCEL,
+            'This occurrence',
+            self.OCCURRENCE,
+            'Whole series',
+            self.SERIES
+        )
+        response = dialog.run()
+        dialog.destroy()
+        return response
+
+    def saved(self, future):
+        '''
+        Report the outcome of a save by the database worker, the window
+        stays open if it failed
+
+        :param future: Result of DatabaseWorker.save
+        :type future: Future
+        '''
+        try:
+            future.result()
+        except Exception as error:
+            self.save_button.set_sensitive(True)
+            self.show_error('The event could not be saved', error)
+            return
+        self.close()
         self.initiator.parent.parent.show_message('Successfully added event')
-        self.window.destroy()
+
+    def delete(self, *args):
+        '''
+        Deletes the event and closes the window. Deleting an occurrence
+        deletes the whole series, which has to be confirmed first.
+        '''
+        if self.event.rrule:
+            dialog = Gtk.MessageDialog(
+                transient_for=self.window,
+                modal=True,
+                message_type=Gtk.MessageType.QUESTION,
+                buttons=Gtk.ButtonsType.OK_CANCEL,
+                text='Delete the series "{}"?'.format(self.event.name)
+            )
+            dialog.format_secondary_text(
+                'This is a recurring event, all of its occurrences will be '
+                'deleted.'
+            )
+            response = dialog.run()
+            dialog.destroy()
+            if response != Gtk.ResponseType.OK:
+                return
+        self.initiator.parent.parent.worker.delete(
+            self.event.copy(),
+            self.deleted
+        )
+
+    def deleted(self, future):
+        '''
+        Report the outcome of a delete by the database worker, the window
+        stays open if it failed
+
+        :param future: Result of DatabaseWorker.delete
+        :type future: Future
+        '''
+        try:
+            future.result()
+        except Exception as error:
+            self.show_error('The event could not be deleted', error)
+            return
+        self.close()
+        self.initiator.parent.parent.show_message('Deleted event')
+
+    def show_error(self, message, error):
+        '''
+        Show an error in a dialog on top of the window
+
+        :param message: What failed
+        :type message: str
+
+        :param error: Why it failed
+        :type error: Exception
+        '''
+        dialog = Gtk.MessageDialog(
+            transient_for=self.window,
+            modal=True,
+            message_type=Gtk.MessageType.ERROR,
+            buttons=Gtk.ButtonsType.CLOSE,
+            text=message
+        )
+        dialog.format_secondary_text(str(error))
+        dialog.run()
+        dialog.destroy()
 
     def close(self, *args):
         '''
         Closes the window
         '''
+        # Give the click event back to the Initiator
         self.initiator.is_blocked = False
         self.window.destroy()
 
@@ -359,7 +679,7 @@ class CalendarDisplay(Gtk.EventBox):
 
     def _edit_event(self, area, *args):
         self.is_blocked = True
-        EventEditor(Event.get_by_id(area.event_id), self)
+        EventEditor(area.event, self)
 
 
 class CalendarEvent(CalendarDisplay):
@@ -380,14 +700,12 @@ class CalendarHour(CalendarDisplay):
     OTHER_TODAY      = (150, 200, 150)
     BUSINESS_TODAY   = (120, 170, 120)
 
-    def __init__(self, date, hour, parent):
+    def __init__(self, date, hour, parent, events=None):
         CalendarDisplay.__init__(self, parent)
         self.date = date
         self.hour = hour
         self.is_blocked = False
 
-        self.set_events()
-
         self.main_box = Gtk.Box(orientation=Gtk.Orientation.HORIZONTAL)
         self.label = Gtk.Label()
         self.grid = Gtk.Grid()
@@ -400,29 +718,33 @@ class CalendarHour(CalendarDisplay):
         self.set_hexpand(True)
         self.set_vexpand(True)
         self.draw()
-        self.refresh_events()
+        self.refresh_events(events)
 
-    def set_events(self):
+    def set_events(self, events=None):
         self.events = set()
-        events = Event.get_by_hour(
-            self.date.year,
-            self.date.month,
-            self.date.day,
-            self.hour,
-        )
+        if events is None:
+            events = Event.get_by_hour(
+                self.date.year,
+                self.date.month,
+                self.date.day,
+                self.hour,
+            )
         [self.add_event(event) for event in events]
 
-    def refresh_events(self):
+    def refresh_events(self, events=None):
         '''
         Refresh the events in the view
+
+        :param events: Pre-fetched events, queried if not given
+        :type events: list[Event]
         '''
         # Remove all widgets
         [widget.destroy() for widget in self.grid]
         # Re-add them
-        self.set_events()
+        self.set_events(events)
         for i, event in enumerate(self.events):
             area = EventDisplay()
-            area.event_id = event.id
+            area.event = event
             area.connect('button-press-event', self._edit_event)
             # Add 5 events per row
             self.grid.attach(area, i % 5, i / 5, 1, 1)
@@ -473,18 +795,22 @@ class CalendarDay(CalendarDisplay):
 
     ODD = (1, 3, 5, 7, 9, 11)
 
-    def __init__(self, date, parent):
+    def __init__(self, date, parent, count=None):
         '''
         Creates a CalendarDay object that represents a box in the main view.
+        Only the number of events is needed to draw it, the events themselves
+        are loaded when one of them is clicked.
 
         :param date: Date
         :type date: date
+
+        :param count: Pre-fetched number of events, queried if not given
+        :type count: int
         '''
         CalendarDisplay.__init__(self, parent)
         self.date = date
         self.is_blocked = False
-
-        self.set_events()
+        self.events = set()
 
         self.main_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         self.grid = Gtk.Grid(row_spacing=5)
@@ -506,36 +832,56 @@ class CalendarDay(CalendarDisplay):
         self.week_label.set_alignment(0.95, 0.9)
         self.label.modify_bg(Gtk.StateType.NORMAL, None)
         self.label.set_text('')
-        self.refresh_events()
+        self.refresh_events(count)
 
-    def set_events(self):
-        self.events = set()
-        events = Event.get_by_day(
-            self.date.year,
-            self.date.month,
-            self.date.day
-        )
-        [self.add_event(event) for event in events]
-
-    def refresh_events(self):
+    def refresh_events(self, count=None):
         '''
         Refresh the events in the view
+
+        :param count: Pre-fetched number of events, queried if not given
+        :type count: int
         '''
         # Remove all widgets
         [widget.destroy() for widget in self.grid]
         # Re-add them
-        self.set_events()
-        for i, event in enumerate(self.events):
+        if count is None:
+            count = Event.get_day_counts(self.date, self.date)[self.date]
+        for i in range(count):
             area = Gtk.DrawingArea(margin_left=5)
             area.set_size_request(15, 15)
             color = Gdk.Color.from_floats(0.2, 0.5, 0.2)
             area.modify_bg(Gtk.StateType.NORMAL, color)
-            area.event_id = event.id
+            area.event_index = i
             area.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
-            area.connect('button-press-event', self._edit_event)
+            area.connect('button-press-event', self._edit_nth_event)
             # Add 5 events per row
             self.grid.attach(area, i % 5, i / 5, 1, 1)
 
+    def _edit_nth_event(self, area, *args):
+        # Keep the click from also creating an event, see FlexView.date_click
+        self.is_blocked = True
+        index = area.event_index
+        self.parent.parent.worker.get_by_day(
+            self.date,
+            lambda future: self.events_loaded(future, index)
+        )
+
+    def events_loaded(self, future, index):
+        '''
+        Open a clicked event once the database worker has loaded the day
+
+        :param future: Result of DatabaseWorker.get_by_day
+        :type future: Future
+
+        :param index: Position of the event in the day
+        :type index: int
+        '''
+        self.is_blocked = False
+        events = future.result()
+        if index < len(events):
+            self.is_blocked = True
+            EventEditor(events[index], self)
+
     def __eq__(self, other):
         '''
         Enables comparisons with other CalendarDays
@@ -616,6 +962,20 @@ class DayView(Gtk.Box):
         self.parent.previous_day_button.connect('clicked', self.decrease)
         self.parent.next_day_button.connect('clicked', self.increase)
         self.parent.this_day_button.connect('clicked', self.goto_today)
+        Event.subscribe(on_main_thread(self.events_changed))
+
+    def events_changed(self, notices):
+        '''
+        Redraw the day if any of the changed events start on it or on the
+        day before, as those can run past midnight
+
+        :param notices: Notices
+        :type notices: list[Notice]
+        '''
+        starts = get_changed_starts(notices)
+        days = (self.current_date - timedelta(days=1), self.current_date)
+        if starts is None or any(start.date() in days for start in starts):
+            self.update_gui()
 
     def add_hours(self):
         business_color = Gdk.Color.from_floats(0.8, 0.8, 0.8)
@@ -656,18 +1016,35 @@ class DayView(Gtk.Box):
             half_line.modify_bg(Gtk.StateType.NORMAL, half_line_color)
             self.grid.attach(half_line, 0, hour * 60 + 30, 7, 1)
 
-    def set_events(self):
-        self.events = set()
-        events = Event.get_by_day(
-            self.current_date.year,
-            self.current_date.month,
-            self.current_date.day
-        )
-        [self.events.add(event) for event in events]
+    @span('DayView.events_loaded')
+    def events_loaded(self, future, day):
+        '''
+        Draw the events of a day once the database worker has loaded them
+
+        :param future: Result of DatabaseWorker.get_by_day
+        :type future: Future
+
+        :param day: Day the events were loaded for
+        :type day: date
+        '''
+        # Skip days the user has already navigated away from
+        if day != self.current_date:
+            return
+        self.events = future.result()
+        self.add_events()
+        self.grid.show_all()
+
+        # Make sure that the lines and hours are on top of the background
+        widgets = self.grid.get_children()
+        [self.toggle(widget) for widget in widgets
+            if isinstance(widget, DaySeparator)]
+
+        [self.toggle(widget) for widget in widgets
+            if isinstance(widget, CalendarDisplay)]
 
     def add_events(self):
-        self.set_events()
-        placed_events = set()
+        index = Event.build_index(self.events)
+        placed = set()
         for event in self.events:
             width = 150
 
@@ -696,29 +1073,29 @@ class DayView(Gtk.Box):
             box.pack_start(titlebar, False, False, 0)
             box.pack_start(label, True, True, 0)
 
-            # Calculate positions of the event
-            start = event.start_hour * 60 + event.start_minute + 2
-            hour_duration = (event.end_hour - event.start_hour) * 60
-            minute_duration = event.end_minute - event.start_minute
-            duration = hour_duration + minute_duration - 3
-
-            display.event.start = start
-            display.event.end = start + duration
-
-            display.set_margin_left(10)
-            # Determine which column the event goes in
-            left = 2
-            for placed_event in placed_events:
-                for i in range(0, duration):
-                    current = event.start + i
-                    higher = placed_event.start < current
-                    lower = placed_event.end > current
-                    if higher and lower:
-                        display.set_margin_left(0)
-                        left = left + 1
-                        break
-
-            placed_events.add(event)
+            # Calculate positions of the event, cutting off events that run
+            # past midnight at the end of the day
+            start_minutes = event.start_hour * 60 + event.start_minute
+            length = event.get_end() - event.get_start()
+            end_minutes = min(start_minutes + length.seconds // 60, 24 * 60)
+            start = start_minutes + 2
+            duration = end_minutes - start_minutes - 3
+
+            # Determine which column the event goes in, one to the right
+            # for every overlapping event already placed
+            overlapping = [
+                other for other in index.overlapping(
+                    event.get_start(),
+                    event.get_end()
+                ) if other.id in placed
+            ]
+            left = 2 + len(overlapping)
+            if overlapping:
+                display.set_margin_left(0)
+            else:
+                display.set_margin_left(10)
+
+            placed.add(event.id)
             self.grid.attach(display, left, start, 1, duration)
 
             display.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
@@ -744,20 +1121,17 @@ class DayView(Gtk.Box):
         self.current_date = date.today()
         self.update_gui()
 
+    @span('DayView.update_gui')
     def update_gui(self):
         self.update_days()
         [widget.destroy() for widget in self.grid]
         self.add_hours()
-        self.add_events()
         self.grid.show_all()
-
-        # Make sure that the lines and hours are on top of the background
-        widgets = self.grid.get_children()
-        [self.toggle(widget) for widget in widgets
-            if isinstance(widget, DaySeparator)]
-
-        [self.toggle(widget) for widget in widgets
-            if isinstance(widget, CalendarDisplay)]
+        day = self.current_date
+        self.parent.worker.get_by_day(
+            day,
+            lambda future: self.events_loaded(future, day)
+        )
 
     def toggle(self, widget):
         widget.hide()
@@ -797,7 +1171,48 @@ class WeekView(Gtk.Box):
         self.add(self.scroller)
 
         self.current_week = Week(date.today())
+        self.calendar_hours = {}
         self.add_days()
+        Event.subscribe(on_main_thread(self.events_changed))
+
+    def events_changed(self, notices):
+        '''
+        Redraw the hours in which changed events start or used to start
+
+        :param notices: Notices
+        :type notices: list[Notice]
+        '''
+        starts = get_changed_starts(notices)
+        if starts is None:
+            self.update_gui()
+            return
+        for key in set((start.date(), start.hour) for start in starts):
+            calendar_hour = self.calendar_hours.get(key)
+            if calendar_hour is not None:
+                self.parent.worker.get_by_day(
+                    key[0],
+                    lambda future, calendar_hour=calendar_hour:
+                        self.hour_loaded(future, calendar_hour)
+                )
+
+    def hour_loaded(self, future, calendar_hour):
+        '''
+        Redraw an hour once the database worker has loaded its day
+
+        :param future: Result of DatabaseWorker.get_by_day
+        :type future: Future
+
+        :param calendar_hour: Hour to redraw
+        :type calendar_hour: CalendarHour
+        '''
+        key = (calendar_hour.date, calendar_hour.hour)
+        # Skip hours of weeks the user has already navigated away from
+        if self.calendar_hours.get(key) is not calendar_hour:
+            return
+        calendar_hour.refresh_events([
+            event for event in future.result()
+            if event.start_hour == calendar_hour.hour
+        ])
 
     def decrease(self, *args):
         self.current_week.decrease()
@@ -827,29 +1242,56 @@ class WeekView(Gtk.Box):
 
         return first_date
 
+    def get_index(self, week_events):
+        '''
+        Index the events of the week
+
+        :param week_events: Events per day, from Event.get_range
+        :type week_events: dict[date, list[Event]]
+
+        :returns IntervalIndex: Index over the events of the week
+        '''
+        return Event.build_index(sum(week_events.values(), []))
+
+    def get_hour_events(self, index, day, hour):
+        '''
+        Get the events starting in an hour of the week
+
+        :param index: Index from get_index
+        :type index: IntervalIndex
+
+        :param day: Date
+        :type day: date
+
+        :param hour: Hour
+        :type hour: int
+
+        :returns list[Event]: Events
+        '''
+        start = datetime(day.year, day.month, day.day, hour)
+        return index.starting(start, start + timedelta(hours=1))
+
+    @span('WeekView.add_days')
     def add_days(self):
         first_date = self.get_first_date()
         [widget.destroy() for widget in self.grid]
+        self.calendar_hours = {}
 
-        # Add all hours in the week
+        # Add all hours in the week, update_gui loads their events
         for day in range(0, 7):
             for hour in range(0, 23):
-                calendar_hour = CalendarHour(first_date, hour, self)
+                calendar_hour = CalendarHour(first_date, hour, self, [])
                 calendar_hour.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
                 calendar_hour.connect('button-press-event', self.hour_click)
                 calendar_hour.date = first_date
+                self.calendar_hours[(first_date, hour)] = calendar_hour
                 self.grid.attach(calendar_hour, day, hour, 1, 1)
             first_date = first_date + self.one_day
         self.update_gui()
 
     def hour_click(self, calendar_hour, *args):
         if not calendar_hour.is_blocked:
-            event = Event()
-            event.date = calendar_hour.date
-            event.start_hour = calendar_hour.hour
-            event.start_minute = 0
-            event.end_hour = calendar_hour.hour + 1
-            event.end_minute = 0
+            event = Event.create(calendar_hour.date, calendar_hour.hour)
             EventEditor(event, calendar_hour)
 
     def initial_scroll(self, *args):
@@ -857,11 +1299,40 @@ class WeekView(Gtk.Box):
             self.scroller.scroll_to(8 * 45 - 5, fast=True)
             self.is_new = False
 
+    @span('WeekView.update_gui')
     def update_gui(self):
         self.update_days()
         self.grid.show_all()
         self.parent.week_label.set_text(self.current_week.get_text())
-        [hour.refresh_events() for hour in self.grid]
+        first_date = self.get_first_date()
+        self.parent.worker.get_range(
+            first_date,
+            first_date + timedelta(6),
+            lambda future: self.week_loaded(future, first_date)
+        )
+
+    @span('WeekView.week_loaded')
+    def week_loaded(self, future, first_date):
+        '''
+        Fill the hours once the database worker has loaded the week
+
+        :param future: Result of DatabaseWorker.get_range
+        :type future: Future
+
+        :param first_date: Monday of the week that was loaded
+        :type first_date: date
+        '''
+        # Skip weeks the user has already navigated away from
+        if first_date != self.get_first_date():
+            return
+        index = self.get_index(future.result())
+        for calendar_hour in self.grid:
+            events = self.get_hour_events(
+                index,
+                calendar_hour.date,
+                calendar_hour.hour
+            )
+            calendar_hour.refresh_events(events)
 
 
 class FlexView(Gtk.Box):
@@ -897,7 +1368,46 @@ class FlexView(Gtk.Box):
 
         current_date = date.today()
         self.current_month = Month(current_date.year, current_date.month)
+        self.calendar_days = {}
         self.set_year(current_date.year)
+        Event.subscribe(on_main_thread(self.events_changed))
+
+    def events_changed(self, notices):
+        '''
+        Redraw the days on which changed events start or used to start
+
+        :param notices: Notices
+        :type notices: list[Notice]
+        '''
+        starts = get_changed_starts(notices)
+        if starts is None:
+            self.update_gui()
+            return
+        for day in set(start.date() for start in starts):
+            calendar_day = self.calendar_days.get(day)
+            if calendar_day is not None:
+                self.parent.worker.get_day_counts(
+                    day,
+                    day,
+                    lambda future, calendar_day=calendar_day:
+                        self.day_counted(future, calendar_day)
+                )
+
+    def day_counted(self, future, calendar_day):
+        '''
+        Redraw a day once the database worker has counted its events
+
+        :param future: Result of DatabaseWorker.get_day_counts
+        :type future: Future
+
+        :param calendar_day: Day to redraw
+        :type calendar_day: CalendarDay
+        '''
+        # Skip days of years the user has already navigated away from
+        if self.calendar_days.get(calendar_day.date) is not calendar_day:
+            return
+        calendar_day.refresh_events(future.result()[calendar_day.date])
+        calendar_day.show_all()
 
     def year_changed(self, combo):
         '''
@@ -914,6 +1424,7 @@ class FlexView(Gtk.Box):
         year = model[iterator][0]
         self.set_year(year)
 
+    @span('FlexView.set_year')
     def set_year(self, year):
         year = int(year)
         # Prevent redrawing the same year
@@ -921,6 +1432,7 @@ class FlexView(Gtk.Box):
             return
         # Clear the CalendarDays
         [widget.destroy() for widget in self.grid]
+        self.calendar_days = {}
 
         # Add calendar days
         self.parent.year = year
@@ -933,12 +1445,13 @@ class FlexView(Gtk.Box):
 
         x = 0
         y = 0
-        # Loop until we reach the end date
+        # Loop until we reach the end date, update_gui loads the counts
         while start_date < end_date:
-            calendar_day = CalendarDay(start_date, self)
+            calendar_day = CalendarDay(start_date, self, 0)
             if start_date.year == self.parent.year:
                 calendar_day.add_events(Gdk.EventMask.BUTTON_PRESS_MASK)
                 calendar_day.connect('button-press-event', self.date_click)
+            self.calendar_days[start_date] = calendar_day
             self.grid.attach(calendar_day, x, y, 1, 1)
             # Iterate!
             start_date = start_date + one_day
@@ -1070,18 +1583,13 @@ class FlexView(Gtk.Box):
         :type calendar_day: CalendarDay
         '''
         if not calendar_day.is_blocked:
-            event = Event()
-            event.date = calendar_day.date
-            now = datetime.now()
-            event.start_hour = now.hour
-            event.end_hour = now.hour + 1
-            event.start_minute = 0
-            event.end_minute = 0
+            event = Event.create(calendar_day.date)
             EventEditor(event, calendar_day)
 
     def draw(self):
         [day.draw(self.current_month) for day in self.grid]
 
+    @span('FlexView.update_gui')
     def update_gui(self):
         '''
         Updates the GUI using the current active month
@@ -1092,9 +1600,38 @@ class FlexView(Gtk.Box):
         self.parent.month_dropdown.set_active(self.current_month.month - 1)
         self.prevent_default = False
 
-        [day.refresh_events() for day in self.grid]
+        days = self.grid.get_children()
+        if days:
+            first_date = min(day.date for day in days)
+            last_date = max(day.date for day in days)
+            year = self.parent.year
+            self.parent.worker.get_day_counts(
+                first_date,
+                last_date,
+                lambda future: self.counts_loaded(future, year)
+            )
         self.parent.show_all()
 
+    @span('FlexView.counts_loaded')
+    def counts_loaded(self, future, year):
+        '''
+        Draw the number of events per day once the database worker has
+        counted them
+
+        :param future: Result of DatabaseWorker.get_day_counts
+        :type future: Future
+
+        :param year: Year that was counted
+        :type year: int
+        '''
+        # Skip years the user has already navigated away from
+        if year != self.parent.year:
+            return
+        year_counts = future.result()
+        for day in self.grid:
+            day.refresh_events(year_counts[day.date])
+        self.grid.show_all()
+
 
 class CalendarWindow(Gtk.Window):
     days = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
@@ -1102,24 +1639,27 @@ class CalendarWindow(Gtk.Window):
     START_YEAR = 2010
     END_YEAR = 2020
 
-    CONFIG_DIR = '.config/pjot-calendar'
-
     def __init__(self):
         '''
         Creates a new Window and fills it with the interface
         '''
         Gtk.Window.__init__(self)
 
-        self.CONFIG_DIR = os.path.join(os.getenv('HOME'), self.CONFIG_DIR)
+        self.CONFIG_DIR = Config.get_directory()
         self.google_client = None
 
-        # Ensure that a config directory exists
-        if not os.path.isdir(self.CONFIG_DIR):
-            os.makedirs(self.CONFIG_DIR)
-
         Event.CONFIG_DIR = self.CONFIG_DIR
 
+        # Queries of the views run on this thread, results come back on
+        # the main loop
+        self.worker = DatabaseWorker(deliver=GLib.idle_add)
+        self.worker.start()
+
         self.config = Config(self.CONFIG_DIR)
+        # Seconds to wait for a running import or sync to finish writing
+        busy_timeout = self.config.get('busy_timeout')
+        if busy_timeout is not None:
+            Event.BUSY_TIMEOUT = busy_timeout
 
         self.set_icon_from_file(os.path.join(
             os.path.dirname(os.path.realpath(__file__)),
@@ -1220,6 +1760,10 @@ class CalendarWindow(Gtk.Window):
         self.toolbar.add(self.day_box)
         box.pack_start(self.toolbar, True, True, 0)
 
+        # Search field
+        self.search_entry = EventSearch(self)
+        box.pack_start(self.search_entry, False, False, 10)
+
         # File button
         file_button = Gtk.Button.new_from_icon_name(
             'list-add', Gtk.IconSize.MENU
@@ -1227,6 +1771,13 @@ class CalendarWindow(Gtk.Window):
         file_button.connect('clicked', self.file_button)
         box.pack_start(file_button, False, False, 0)
 
+        # Export button
+        export_button = Gtk.Button.new_from_icon_name(
+            'document-save', Gtk.IconSize.MENU
+        )
+        export_button.connect('clicked', self.export_button)
+        box.pack_start(export_button, False, False, 0)
+
         # Google button
         self.google_button = Gtk.Button.new_from_icon_name(
             Gtk.STOCK_REFRESH, Gtk.IconSize.MENU
@@ -1254,22 +1805,26 @@ class CalendarWindow(Gtk.Window):
         )
         self.app_container.pack_start(self.days_grid, False, True, 5)
 
-        # Add views
-        self.day_view = DayView(self, date.today())
-        self.week_view = WeekView(self)
-        self.flex_view = FlexView(self)
-
-        self.stack.add_titled(self.day_view, 'day', 'Day')
-        self.stack.add_titled(self.week_view, 'week', 'Week')
-        self.stack.add_titled(self.flex_view, 'flex', 'Flex')
+        # Add a page per view, the views are built when first shown
+        self.views = {}
+        self.view_boxes = {}
+        pages = (('day', 'Day'), ('week', 'Week'), ('flex', 'Flex'))
+        for name, title in pages:
+            self.view_boxes[name] = Gtk.Box()
+            self.stack.add_titled(self.view_boxes[name], name, title)
 
         self.app_container.pack_start(self.stack, False, True, 5)
 
+        # Import progress, only shown while importing
+        self.progress_bar = Gtk.ProgressBar(show_text=True)
+        self.progress_bar.set_no_show_all(True)
+        self.app_container.pack_start(self.progress_bar, False, True, 5)
+
         # Message bar
         self.app_container.pack_start(self.message_bar, False, True, 5)
 
         # Day view is the default
-        self.current_view = self.day_view
+        self.current_view, built = self.get_view('day')
         self.current_view.update_days()
 
         self.add(self.app_container)
@@ -1306,25 +1861,48 @@ class CalendarWindow(Gtk.Window):
         else:
             self.set_view('week')
 
+    def get_view(self, name):
+        '''
+        Get a view, building it and adding it to its page of the stack the
+        first time. Only the views the user opens load their events.
+
+        :param name: Name of the view, day, week or flex
+        :type name: str
+
+        :returns tuple: The view and whether it was built just now
+        '''
+        built = name not in self.views
+        if built:
+            if name == 'week':
+                view = WeekView(self)
+            elif name == 'day':
+                view = DayView(self, date.today())
+            else:
+                view = FlexView(self)
+            self.views[name] = view
+            self.view_boxes[name].pack_start(view, True, True, 0)
+            self.view_boxes[name].show_all()
+        return self.views[name], built
+
     def set_view(self, view):
         self.stack.set_visible_child_name(view)
 
         for widget in self.toolbar:
             self.toolbar.remove(widget)
 
+        self.current_view, built = self.get_view(view)
         if view == 'week':
-            self.current_view = self.week_view
             self.toolbar.add(self.week_box)
         elif view == 'day':
-            self.current_view = self.day_view
             self.toolbar.add(self.day_box)
         else:
-            self.current_view = self.flex_view
             self.toolbar.add(self.flex_box)
 
         self.current_view.initial_scroll()
         self.current_view.update_days()
-        self.current_view.update_gui()
+        # WeekView and FlexView load their events when they are built
+        if not built or view == 'day':
+            self.current_view.update_gui()
         self.toolbar.show_all()
 
     def settings_editor(self, *args):
@@ -1357,34 +1935,159 @@ class CalendarWindow(Gtk.Window):
             self.open_file(dialog.get_filename())
         dialog.destroy()
 
+    def export_button(self, *args):
+        '''
+        Ask for a file and export the events to it. When something is typed
+        in the search field only the matching events can be exported.
+        '''
+        import exporter
+
+        dialog = Gtk.FileChooserDialog(
+            "Export to",
+            self,
+            Gtk.FileChooserAction.SAVE,
+            (
+                Gtk.STOCK_CANCEL,
+                Gtk.ResponseType.CANCEL,
+                Gtk.STOCK_SAVE,
+                Gtk.ResponseType.OK
+            )
+        )
+        dialog.set_do_overwrite_confirmation(True)
+        dialog.set_current_name('calendar.ics')
+        query = self.search_entry.get_text().strip()
+        matching = Gtk.CheckButton(
+            'Only events matching "{}"'.format(query)
+        )
+        if query:
+            dialog.set_extra_widget(matching)
+        response = dialog.run()
+        if response == Gtk.ResponseType.OK:
+            self.worker.submit(
+                exporter.export_file,
+                (
+                    dialog.get_filename(),
+                    None,
+                    None,
+                    query if matching.get_active() else None
+                ),
+                self.file_exported
+            )
+        dialog.destroy()
+
+    def file_exported(self, future):
+        '''
+        Report the outcome of an export
+
+        :param future: Result of exporter.export_file
+        :type future: Future
+        '''
+        try:
+            count = future.result()
+        except Exception as error:
+            self.show_message('Export failed: {}'.format(error))
+            return
+        self.show_message('Exported {} events'.format(count))
+
     def open_file(self, file_path):
-        with open(file_path) as f:
-            data = f.read()
-        cal = Calendar.from_ical(data)
-        for component in cal.walk():
-            if component.name == 'VEVENT':
-                tz_offset = timedelta(seconds=time.timezone)
-                name = component.get('summary')
-                start = component.get('dtstart').dt - tz_offset
-                end = component.get('dtend').dt - tz_offset
-                location = component.get('location')
-                event = Event()
-                event.name = name
-                event.location = location
-                event.year = start.year
-                event.month = start.month
-                event.day = start.day
-                event.start_hour = int(start.strftime('%H')) + 1
-                event.start_minute = int(start.strftime('%M'))
-                event.end_hour = int(end.strftime('%H')) + 1
-                event.end_minute = int(end.strftime('%M'))
-                if self.config.get('google_sync'):
-                    google = self.get_google_client()
-                    google.set_calendar_id()
-                    google.export_event(event)
-                event.save()
-                self.show_message('Successfully added event')
-                self.current_view.update_gui()
+        '''
+        Import the events of an iCalendar file on the database worker. The
+        file is read one event at a time and saved in one transaction, the
+        progress bar follows along and the current view is refreshed once
+        at the end.
+
+        :param file_path: Path to the file
+        :type file_path: str
+        '''
+        import importer
+
+        export = None
+        if self.config.get('google_sync'):
+            google = self.get_google_client()
+            google.set_calendar_id()
+            export = google.export_event
+        self.progress_bar.set_fraction(0)
+        self.progress_bar.set_text(os.path.basename(file_path))
+        self.progress_bar.show()
+        self.worker.submit(
+            importer.import_file,
+            (file_path, on_main_thread(self.import_progress), export),
+            self.file_imported
+        )
+
+    def open_files(self, paths, prune=False):
+        '''
+        Import several iCalendar files or directories of them on the
+        database worker. The files are parsed in a pool of processes, the
+        time each took is printed and the progress bar counts the files.
+
+        :param paths: Paths to files and directories
+        :type paths: list[str]
+
+        :param prune: Whether to delete events that were removed from the
+            files since they were last imported
+        :type prune: bool
+        '''
+        import importer
+
+        files = importer.find_files(paths)
+        done = []
+
+        def parsed(path, count, seconds):
+            done.append(path)
+            print '{}: {} events parsed in {:.2f}s'.format(
+                path,
+                count,
+                seconds
+            )
+            self.progress_bar.set_fraction(len(done) / float(len(files)))
+            self.progress_bar.set_text(
+                'Parsed {} of {} files'.format(len(done), len(files))
+            )
+
+        self.progress_bar.set_fraction(0)
+        self.progress_bar.set_text('Parsing {} files'.format(len(files)))
+        self.progress_bar.show()
+        self.worker.submit(
+            importer.import_files,
+            (files, None, on_main_thread(parsed), prune),
+            self.file_imported
+        )
+
+    def import_progress(self, count, fraction):
+        '''
+        Show the progress of an import
+
+        :param count: Number of events saved so far
+        :type count: int
+
+        :param fraction: Fraction of the file that has been read
+        :type fraction: float
+        '''
+        self.progress_bar.set_fraction(fraction)
+        self.progress_bar.set_text('Imported {} events'.format(count))
+
+    def file_imported(self, future):
+        '''
+        Report the outcome of an import and show the new events
+
+        :param future: Result of importer.import_file or import_files
+        :type future: Future
+        '''
+        self.progress_bar.hide()
+        try:
+            imported = future.result()
+        except Exception as error:
+            self.show_message('Import failed: {}'.format(error))
+            return
+        self.show_message(
+            'Added {}, updated {} and removed {} events'.format(
+                imported.added,
+                imported.updated,
+                imported.deleted
+            )
+        )
+        self.current_view.update_gui()
 
     def set_day_labels(self, labels):
         [widget.destroy() for widget in self.days_grid]
@@ -1398,6 +2101,14 @@ class CalendarWindow(Gtk.Window):
 
 class Google:
     def __init__(self, parent):
+        from apiclient import discovery
+        from oauth2client import file
+        from oauth2client import client
+        from oauth2client import tools
+
+        import argparse
+        import httplib2
+
         self.calendar_id = None
         self.parent = parent
         arg_parser = argparse.ArgumentParser(
@@ -1463,51 +2174,66 @@ class Google:
         return event
 
     def import_events(self):
+        '''
+        Import the events of the calendar on the database worker, the views
+        redraw through Event.subscribe
+        '''
+        self.parent.worker.submit(
+            Event.import_google,
+            (self.service, self.calendar_id),
+            self.events_imported
+        )
 
-        request = self.service.events().list(calendarId=self.calendar_id)
-        events = request.execute()
-
-        items = 0
-        for item in events['items']:
-            event = Event.get_by_google_id(item['id'])
-
-            if 'dateTime' in item['start']:
-                start_dt = parser.parse(item['start']['dateTime'])
-            else:
-                start_dt = parser.parse(item['start']['date'])
+    def events_imported(self, future):
+        '''
+        Report the outcome of an import
 
-            if 'dateTime' in item['end']:
-                end_dt = parser.parse(item['end']['dateTime'])
-                event.end_hour = end_dt.hour
-                event.end_minute = end_dt.minute
-            else:
-                end_dt = parser.parse(item['end']['date'])
-                event.end_hour = 23
-                event.end_minute = 59
-
-            event.year = start_dt.year
-            event.month = start_dt.month
-            event.day = start_dt.day
-            event.start_hour = start_dt.hour
-            event.start_minute = start_dt.minute
-
-            event.google_id = item['id']
-            event.name = item['summary']
-            if 'location' in item:
-                event.location = item['location']
-
-            event.save()
-            items = items + 1
-        message = 'Successfully imported {} items'.format(items)
+        :param future: Result of Event.import_google
+        :type future: Future
+        '''
+        try:
+            count = future.result()
+        except Exception as error:
+            self.parent.show_message('Import failed: {}'.format(error))
+            return
+        message = 'Successfully imported {} items'.format(count)
         self.parent.show_message(message)
 
 
-win = CalendarWindow()
-win.connect("delete-event", Gtk.main_quit)
-
-opts, args = getopt.getopt(sys.argv[1:], 'i', ['import='])
-for opt, arg in opts:
-    if opt in ('-i', '--import'):
-        win.open_file(arg)
-
-Gtk.main()
+def main():
+    '''
+    Open the window and run the main loop
+    '''
+    # Files and directories to import can be given with --import or after it
+    opts, args = getopt.getopt(
+        sys.argv[1:],
+        'i:',
+        ['import=', 'prune', 'rebuild-search', 'profile', 'profile-dump=']
+    )
+    dumps = [arg for opt, arg in opts if opt == '--profile-dump']
+    if ('--profile', '') in opts or dumps:
+        Profiler.enable(dumps[-1] if dumps else None)
+
+    with span('CalendarWindow'):
+        win = CalendarWindow()
+    win.connect("delete-event", Gtk.main_quit)
+    if Profiler.enabled:
+        def first_draw(*args):
+            win.disconnect(handler)
+            Profiler.add('first draw', time.time() - Profiler.started)
+        handler = win.connect('draw', first_draw)
+
+    imports = [arg for opt, arg in opts if opt in ('-i', '--import')]
+    if imports:
+        win.open_files(imports + args, ('--prune', '') in opts)
+    if ('--rebuild-search', '') in opts:
+        win.worker.submit(Event.rebuild_search_index)
+
+    Gtk.main()
+    # Let the saves that were queued when the window closed finish
+    win.worker.stop()
+    Profiler.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,186 @@
+'''
+Command line interface that works on the events without starting the
+window. Only the modules a command needs are imported, and never GTK or the
+Google client, so that scripts and cron jobs start quickly.
+
+    ./calendar import exports/ other.ics
+    ./calendar export --from 2016-01-01 --to 2016-12-31 2016.ics
+    ./calendar agenda --from 2016-03-01 --days 7
+    ./calendar search dentist
+'''
+from datetime import date, timedelta, datetime
+from event import Event
+from config import Config
+
+import argparse
+import sys
+
+
+COMMANDS = ('import', 'export', 'agenda', 'search')
+
+
+def parse_date(value):
+    '''
+    Parse a date given on the command line
+
+    :param value: Date as YYYY-MM-DD
+    :type value: str
+
+    :returns date: Date
+    '''
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'expected a date like 2016-03-01, got {}'.format(value)
+        )
+
+
+def format_event(event):
+    '''
+    Format an event as a line of text
+
+    :param event: Event
+    :type event: Event
+
+    :returns str: Line
+    '''
+    line = '{:%H:%M}-{:%H:%M}  {}'.format(
+        event.get_start(),
+        event.get_end(),
+        event.name
+    )
+    if event.location:
+        line = line + ' (' + event.location + ')'
+    return line
+
+
+def import_command(args):
+    '''
+    Import files or directories of them
+    '''
+    import importer
+
+    def parsed(path, count, seconds):
+        print '{}: {} events parsed in {:.2f}s'.format(path, count, seconds)
+
+    files = importer.find_files(args.paths)
+    if len(files) == 1:
+        imported = importer.import_file(files[0], prune=args.prune)
+    else:
+        imported = importer.import_files(
+            files,
+            args.processes,
+            parsed,
+            args.prune
+        )
+    print 'Added {}, updated {}, unchanged {} and removed {} events'.format(
+        imported.added,
+        imported.updated,
+        imported.unchanged,
+        imported.deleted
+    )
+
+
+def export_command(args):
+    '''
+    Export events to a file or to stdout
+    '''
+    import exporter
+
+    events = exporter.get_events(args.start, args.end, args.search)
+    if args.path == '-':
+        exporter.export_events(sys.stdout, events)
+        return
+    with open(args.path, 'w') as out:
+        count = exporter.export_events(out, events)
+    print 'Exported {} events'.format(count)
+
+
+def agenda_command(args):
+    '''
+    Print the events of a number of days
+    '''
+    start_date = args.start or date.today()
+    end_date = start_date + timedelta(args.days - 1)
+    days = Event.get_range(start_date, end_date)
+    for day in sorted(days.keys()):
+        if not days[day]:
+            continue
+        print day.strftime('%a %Y-%m-%d')
+        for event in sorted(days[day], key=lambda event: event.get_start()):
+            print '  ' + format_event(event)
+
+
+def search_command(args):
+    '''
+    Print the events matching a search
+    '''
+    for event in Event.search(' '.join(args.query), args.limit):
+        print '{:%Y-%m-%d}  {}'.format(event.get_start(), format_event(event))
+
+
+def get_parser():
+    '''
+    Create the parser for the command line
+
+    :returns argparse.ArgumentParser: Parser
+    '''
+    parser = argparse.ArgumentParser(
+        prog='calendar',
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser('import', help='import .ics files')
+    command.add_argument('paths', nargs='+', help='files or directories')
+    command.add_argument(
+        '--prune',
+        action='store_true',
+        help='remove events that were removed from the files'
+    )
+    command.add_argument(
+        '--processes',
+        type=int,
+        help='processes to parse with, one per core by default'
+    )
+    command.set_defaults(function=import_command)
+
+    command = commands.add_parser('export', help='export to an .ics file')
+    command.add_argument('path', nargs='?', default='-', help='- for stdout')
+    command.add_argument('--from', dest='start', type=parse_date)
+    command.add_argument('--to', dest='end', type=parse_date)
+    command.add_argument('--search', help='only events matching this')
+    command.set_defaults(function=export_command)
+
+    command = commands.add_parser('agenda', help='list upcoming events')
+    command.add_argument('--from', dest='start', type=parse_date)
+    command.add_argument('--days', type=int, default=7)
+    command.set_defaults(function=agenda_command)
+
+    command = commands.add_parser('search', help='find events')
+    command.add_argument('query', nargs='+')
+    command.add_argument('--limit', type=int, default=20)
+    command.set_defaults(function=search_command)
+
+    return parser
+
+
+def main(argv):
+    '''
+    Run a command
+
+    :param argv: Arguments, without the name of the program
+    :type argv: list[str]
+    '''
+    args = get_parser().parse_args(argv)
+    Event.CONFIG_DIR = Config.get_directory()
+    busy_timeout = Config(Event.CONFIG_DIR).get('busy_timeout')
+    if busy_timeout is not None:
+        Event.BUSY_TIMEOUT = busy_timeout
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -9,6 +9,21 @@ class Config(object):
     '''
     Class that simplifies storing and reading values from a config file
     '''
+    DIRECTORY = '.config/pjot-calendar'
+
+    @staticmethod
+    def get_directory():
+        '''
+        Get the directory the config and the events are stored in, creating
+        it if it does not exist yet
+
+        :returns str: Path
+        '''
+        directory = os.path.join(os.getenv('HOME'), Config.DIRECTORY)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return directory
+
     def __init__(self, config_path):
         '''
         Create a new Config object using the supplied path.
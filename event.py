@@ -1,13 +1,585 @@
+from collections import OrderedDict, namedtuple
 from datetime import date, timedelta, datetime
+from intervals import IntervalIndex
+from recurrence import RecurrenceCache
+from functools import wraps
+from profiler import Profiler, Connection
 
+import recurrence
+
+import threading
+import hashlib
 import sqlite3
 import os
 
 
-class Event:
+# One entry of the change journal, see Event.get_changes
+Change = namedtuple('Change', ('seq', 'event_id', 'op', 'changed_at'))
+
+# Published to the subscribers of Event when an event is saved or deleted.
+# The starts are None before an event is created and after it is deleted.
+Notice = namedtuple(
+    'Notice',
+    ('event_id', 'old_start', 'new_start', 'is_recurring')
+)
+
+
+def synchronized(function):
+    '''
+    Decorator that holds Event.lock while a function runs, for the state
+    that every thread shares besides the caches, like the connection
+    generation. Statements run outside of the lock, on the connection of the
+    thread.
+    '''
+    @wraps(function)
+    def locked(*args, **kwargs):
+        with Event.lock:
+            return function(*args, **kwargs)
+    return locked
+
+
+def fill_last_starts(cursor):
+    '''
+    Store the start of the last occurrence of every series that was saved
+    before events.last_starts_at existed, run by migration 9
+
+    :param cursor: Cursor
+    :type cursor: sqlite3.Cursor
+    '''
+    cursor.execute('select id, starts_at, rrule from events \
+        where rrule is not null')
+    values = []
+    for id, starts_at, rule in cursor.fetchall():
+        last_start = recurrence.get_last_start(
+            rule,
+            Event.from_timestamp(starts_at)
+        )
+        if last_start is not None:
+            values.append((Event.to_timestamp(last_start), id))
+    cursor.executemany(
+        'update events set last_starts_at = ? where id = ?',
+        values
+    )
+
+
+def fill_uids(cursor):
+    '''
+    Give the events that were saved before every event had a UID one, run
+    by migration 10
+
+    :param cursor: Cursor
+    :type cursor: sqlite3.Cursor
+    '''
+    cursor.execute('select {} from events where uid is null'.format(
+        ', '.join(Event.COLUMNS)
+    ))
+    values = []
+    for row in cursor.fetchall():
+        event = Event.from_row(row)
+        event.set_identity()
+        values.append((event.uid, event.content_hash, event.id))
+    cursor.executemany(
+        'update events set uid = ?, content_hash = ? where id = ?',
+        values
+    )
+
+
+class EventCache:
+    MAX_EVENTS = 5000
+    MAX_DAYS = 1000
+
+    def __init__(self):
+        '''
+        Creates an in-process LRU cache of Events keyed by id and by the day
+        they start on. Writes go through Event.save, which keeps the cache up
+        to date.
+        '''
+        self.hits = 0
+        self.misses = 0
+        # Changes with every removal, see Event.get_by_day
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        '''
+        Remove everything from the cache
+        '''
+        self.version = self.version + 1
+        self.events = OrderedDict()
+        self.days = OrderedDict()
+        # Which cached days every event id appears in
+        self.event_days = {}
+        # Last change in the journal the cache is up to date with
+        self.seq = None
+
+    def _touch(self, store, key):
+        '''
+        Mark a key as most recently used and return its value
+        '''
+        value = store.pop(key)
+        store[key] = value
+        return value
+
+    def get(self, id):
+        '''
+        Get an Event by id. Events only seen as part of a day are not
+        indexed by id, which keeps loading whole years cheap.
+
+        :param id: ID
+        :type id: int
+
+        :returns Event|None: The Event, None if it is not cached
+        '''
+        if id in self.events:
+            self.hits = self.hits + 1
+            return self._touch(self.events, id)
+        self.misses = self.misses + 1
+        return None
+
+    def get_day(self, day):
+        '''
+        Get the Events starting on a day
+
+        :param day: Day
+        :type day: date
+
+        :returns list[Event]|None: The Events, None if the day is not cached
+        '''
+        if day in self.days:
+            self.hits = self.hits + 1
+            return list(self._touch(self.days, day))
+        self.misses = self.misses + 1
+        return None
+
+    def get_days(self, days):
+        '''
+        Get the Events of several days, counted as a single lookup
+
+        :param days: Days
+        :type days: list[date]
+
+        :returns dict[date, list[Event]]|None: Events per day, None unless
+            every day is cached
+        '''
+        if not all(day in self.days for day in days):
+            self.misses = self.misses + 1
+            return None
+        self.hits = self.hits + 1
+        return dict((day, list(self._touch(self.days, day))) for day in days)
+
+    def add(self, event):
+        '''
+        Add or replace an Event
+
+        :param event: Event
+        :type event: Event
+        '''
+        self.events.pop(event.id, None)
+        self.events[event.id] = event
+        while len(self.events) > self.MAX_EVENTS:
+            self.events.popitem(last=False)
+
+    def add_day(self, day, events):
+        '''
+        Cache all Events starting on a day
+
+        :param day: Day
+        :type day: date
+
+        :param events: Events
+        :type events: list[Event]
+        '''
+        self.remove_day(day)
+        self.days[day] = list(events)
+        for event in events:
+            self.event_days.setdefault(event.id, set()).add(day)
+        while len(self.days) > self.MAX_DAYS:
+            self.remove_day(next(iter(self.days)))
+
+    def remove_day(self, day):
+        '''
+        Remove a day from the cache
+
+        :param day: Day
+        :type day: date
+        '''
+        for event in self.days.pop(day, []):
+            days = self.event_days.get(event.id)
+            if days is not None:
+                days.discard(day)
+                if not days:
+                    del self.event_days[event.id]
+
+    def clear_days(self):
+        '''
+        Remove all days, keeping the events cached by id
+        '''
+        self.version = self.version + 1
+        self.days = OrderedDict()
+        self.event_days = {}
+
+    def remove(self, id):
+        '''
+        Remove an Event and every day it is listed on
+
+        :param id: ID
+        :type id: int
+        '''
+        self.version = self.version + 1
+        for day in list(self.event_days.get(id, [])):
+            self.remove_day(day)
+        self.events.pop(id, None)
+
+    def update(self, event):
+        '''
+        Write through a saved Event, dropping the days it was listed on
+        before and the day it is on now. A recurring event can show up on
+        any day, so all days are dropped for those.
+
+        :param event: Event
+        :type event: Event
+        '''
+        self.version = self.version + 1
+        if event.rrule:
+            self.clear_days()
+        self.remove(event.id)
+        self.remove_day(event.get_date())
+        if not event.is_occurrence():
+            self.add(event)
+
+    def get_stats(self):
+        '''
+        Get the cache counters
+
+        :returns dict: Hits, misses and number of cached events and days
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'events': len(self.events),
+            'days': len(self.days),
+        }
+
+
+class Event(object):
+    # Thousands of events are loaded at once, slots keep them small
+    __slots__ = (
+        'is_saved',
+        'name',
+        'time',
+        'id',
+        'google_id',
+        'location',
+        'date',
+        'year',
+        'month',
+        'day',
+        'start_hour',
+        'start_minute',
+        'end_hour',
+        'end_minute',
+        'rrule',
+        'series_offset',
+        'stored_start',
+        'stored_rrule',
+        'uid',
+        'content_hash',
+        'source',
+    )
+
     is_connected = False
-    connection = None
+    lock = threading.RLock()
+    # Every thread gets its own connection, see get_connection
+    local = threading.local()
+    generation = 0
+    # Seconds to wait for another connection to release a lock
+    BUSY_TIMEOUT = 5.0
+    # Above this many changed events sync_cache starts over
+    MAX_SYNCED = 500
     CONFIG_DIR = None
+    cache = EventCache()
+    recurrences = RecurrenceCache()
+    subscribers = []
+
+    # Each migration is a list of statements bringing the schema from the
+    # version equal to its index to the next one, or functions taking a
+    # cursor for what SQL can not do. Only ever append here.
+    MIGRATIONS = (
+        # 1: Initial schema
+        (
+            'create table if not exists \
+                events ( \
+                    id integer primary key, \
+                    name text, \
+                    location text, \
+                    year int, \
+                    month int, \
+                    day int, \
+                    start_hour int, \
+                    start_minute int, \
+                    end_hour int, \
+                    end_minute int, \
+                    google_id varchar(255) \
+                )',
+        ),
+        # 2: Indexes for the day/hour lookups and Google syncing. Events
+        # without a Google id store NULL so that the unique index allows
+        # more than one of them. Later copies of a Google id keep their event
+        # but lose the id, the next sync links the first one.
+        (
+            "update events set google_id = null \
+                where google_id in ('', 'None')",
+            'update events set google_id = null \
+                where google_id is not null and id not in ( \
+                    select min(id) from events \
+                    where google_id is not null \
+                    group by google_id \
+                )',
+            'create index if not exists events_day \
+                on events (year, month, day, start_hour)',
+            'create unique index if not exists events_google_id \
+                on events (google_id)',
+        ),
+        # 3: Store start and end as timestamps, see Event.to_timestamp. An
+        # end before the start means that the event runs past midnight.
+        (
+            'drop table if exists events_v2',
+            'create table events_v2 ( \
+                id integer primary key, \
+                name text, \
+                location text, \
+                starts_at int not null, \
+                ends_at int not null, \
+                google_id varchar(255) \
+            )',
+            "insert into events_v2 \
+                (id, name, location, starts_at, ends_at, google_id) \
+                select \
+                    id, \
+                    name, \
+                    location, \
+                    midnight + start_hour * 3600 + start_minute * 60, \
+                    midnight + end_hour * 3600 + end_minute * 60 + \
+                        case when end_hour * 60 + end_minute < \
+                            start_hour * 60 + start_minute \
+                        then 86400 else 0 end, \
+                    google_id \
+                from ( \
+                    select *, cast(strftime('%s', printf( \
+                        '%04d-%02d-%02d', year, month, day \
+                    )) as int) as midnight \
+                    from events \
+                )",
+            'drop table events',
+            'alter table events_v2 rename to events',
+            'create index if not exists events_starts_at \
+                on events (starts_at)',
+            'create index if not exists events_ends_at on events (ends_at)',
+            'create unique index if not exists events_google_id \
+                on events (google_id)',
+        ),
+        # 4: Number of events per day, keyed like 20160301 and kept up to
+        # date by triggers, see Event.get_day_counts
+        (
+            'create table if not exists day_counts ( \
+                day integer primary key, \
+                count int not null \
+            )',
+            'delete from day_counts',
+            "insert into day_counts (day, count) \
+                select \
+                    cast(strftime('%Y%m%d', starts_at, 'unixepoch') as int), \
+                    count(*) \
+                from events \
+                group by 1",
+            "create trigger if not exists day_counts_insert \
+                after insert on events \
+                begin \
+                    insert or ignore into day_counts (day, count) values ( \
+                        cast(strftime('%Y%m%d', new.starts_at, 'unixepoch') \
+                            as int), \
+                        0 \
+                    ); \
+                    update day_counts set count = count + 1 \
+                        where day = cast(strftime( \
+                            '%Y%m%d', new.starts_at, 'unixepoch' \
+                        ) as int); \
+                end",
+            "create trigger if not exists day_counts_delete \
+                after delete on events \
+                begin \
+                    update day_counts set count = count - 1 \
+                        where day = cast(strftime( \
+                            '%Y%m%d', old.starts_at, 'unixepoch' \
+                        ) as int); \
+                    delete from day_counts where count <= 0; \
+                end",
+            "create trigger if not exists day_counts_update \
+                after update of starts_at on events \
+                begin \
+                    update day_counts set count = count - 1 \
+                        where day = cast(strftime( \
+                            '%Y%m%d', old.starts_at, 'unixepoch' \
+                        ) as int); \
+                    insert or ignore into day_counts (day, count) values ( \
+                        cast(strftime('%Y%m%d', new.starts_at, 'unixepoch') \
+                            as int), \
+                        0 \
+                    ); \
+                    update day_counts set count = count + 1 \
+                        where day = cast(strftime( \
+                            '%Y%m%d', new.starts_at, 'unixepoch' \
+                        ) as int); \
+                    delete from day_counts where count <= 0; \
+                end",
+        ),
+        # 5: Full text index over names and locations, kept in sync with
+        # events by triggers, see Event.search
+        (
+            "create virtual table if not exists events_search using fts5( \
+                name, \
+                location, \
+                content='events', \
+                content_rowid='id' \
+            )",
+            "insert into events_search (events_search) values ('rebuild')",
+            'create trigger if not exists events_search_insert \
+                after insert on events \
+                begin \
+                    insert into events_search (rowid, name, location) \
+                        values (new.id, new.name, new.location); \
+                end',
+            "create trigger if not exists events_search_delete \
+                after delete on events \
+                begin \
+                    insert into events_search \
+                        (events_search, rowid, name, location) \
+                        values ('delete', old.id, old.name, old.location); \
+                end",
+            "create trigger if not exists events_search_update \
+                after update of name, location on events \
+                begin \
+                    insert into events_search \
+                        (events_search, rowid, name, location) \
+                        values ('delete', old.id, old.name, old.location); \
+                    insert into events_search (rowid, name, location) \
+                        values (new.id, new.name, new.location); \
+                end",
+        ),
+        # 6: Recurring events. A series is stored once with its rule, see
+        # Event.get_occurrences. day_counts only counts single events, the
+        # occurrences are added when the counts are read.
+        (
+            'alter table events add column rrule text',
+            'create index if not exists events_recurring \
+                on events (starts_at) where rrule is not null',
+            'drop trigger if exists day_counts_insert',
+            'drop trigger if exists day_counts_delete',
+            'drop trigger if exists day_counts_update',
+            "create trigger day_counts_insert \
+                after insert on events when new.rrule is null \
+                begin \
+                    insert or ignore into day_counts (day, count) values ( \
+                        cast(strftime('%Y%m%d', new.starts_at, 'unixepoch') \
+                            as int), \
+                        0 \
+                    ); \
+                    update day_counts set count = count + 1 \
+                        where day = cast(strftime( \
+                            '%Y%m%d', new.starts_at, 'unixepoch' \
+                        ) as int); \
+                end",
+            "create trigger day_counts_delete \
+                after delete on events when old.rrule is null \
+                begin \
+                    update day_counts set count = count - 1 \
+                        where day = cast(strftime( \
+                            '%Y%m%d', old.starts_at, 'unixepoch' \
+                        ) as int); \
+                    delete from day_counts where count <= 0; \
+                end",
+            "create trigger day_counts_update_old \
+                after update of starts_at, rrule on events \
+                when old.rrule is null \
+                begin \
+                    update day_counts set count = count - 1 \
+                        where day = cast(strftime( \
+                            '%Y%m%d', old.starts_at, 'unixepoch' \
+                        ) as int); \
+                    delete from day_counts where count <= 0; \
+                end",
+            "create trigger day_counts_update_new \
+                after update of starts_at, rrule on events \
+                when new.rrule is null \
+                begin \
+                    insert or ignore into day_counts (day, count) values ( \
+                        cast(strftime('%Y%m%d', new.starts_at, 'unixepoch') \
+                            as int), \
+                        0 \
+                    ); \
+                    update day_counts set count = count + 1 \
+                        where day = cast(strftime( \
+                            '%Y%m%d', new.starts_at, 'unixepoch' \
+                        ) as int); \
+                end",
+        ),
+        # 7: Append-only journal of every insert, update and delete of an
+        # event, see Event.get_changes
+        (
+            'create table if not exists changes ( \
+                seq integer primary key autoincrement, \
+                event_id int not null, \
+                op text not null, \
+                changed_at int not null \
+            )',
+            "create trigger if not exists changes_insert \
+                after insert on events \
+                begin \
+                    insert into changes (event_id, op, changed_at) \
+                        values (new.id, 'insert', strftime('%s', 'now')); \
+                end",
+            "create trigger if not exists changes_update \
+                after update on events \
+                begin \
+                    insert into changes (event_id, op, changed_at) \
+                        values (new.id, 'update', strftime('%s', 'now')); \
+                end",
+            "create trigger if not exists changes_delete \
+                after delete on events \
+                begin \
+                    insert into changes (event_id, op, changed_at) \
+                        values (old.id, 'delete', strftime('%s', 'now')); \
+                end",
+        ),
+        # 8: Imported events remember their UID, a hash of their content
+        # and the file they came from, so that re-imports can skip or update
+        # them, see importer.import_events
+        (
+            'alter table events add column uid text',
+            'alter table events add column content_hash text',
+            'alter table events add column source text',
+            'create unique index if not exists events_uid on events (uid)',
+            'create index if not exists events_source on events (source)',
+        ),
+        # 9: Start of the last occurrence of a series, NULL if it never
+        # ends, so that lookups skip the series that are over, see
+        # Event.get_series
+        (
+            'alter table events add column last_starts_at int',
+            fill_last_starts,
+            'create index if not exists events_last_starts_at \
+                on events (last_starts_at) where rrule is not null',
+        ),
+        # 10: Events created in the app or synced from Google get a UID as
+        # well, so that exporting and importing them again adds nothing,
+        # see Event.set_identity
+        (
+            fill_uids,
+        ),
+    )
+
+    EPOCH = datetime(1970, 1, 1)
+    EPOCH_ORDINAL = EPOCH.toordinal()
 
     def __init__(self):
         '''
@@ -20,13 +592,241 @@ class Event:
         self.id = ''
         self.google_id = ''
         self.location = ''
-        now = datetime.now()
-        self.start_hour = now.hour
-        self.start_minute = now.minute
-        now = now + timedelta(hours=1)
-        self.end_hour = now.hour
-        self.end_minute = now.minute
         self.date = None
+        self.year = None
+        self.month = None
+        self.day = None
+        self.start_hour = 0
+        self.start_minute = 0
+        self.end_hour = 1
+        self.end_minute = 0
+        self.rrule = None
+        # Occurrences of a series are shifted from the stored series
+        self.series_offset = timedelta(0)
+        # What the database holds, to tell subscribers what changed
+        self.stored_start = None
+        self.stored_rrule = None
+        # Where an imported event came from, see importer.import_events and
+        # set_identity
+        self.uid = None
+        self.content_hash = None
+        self.source = None
+
+    @staticmethod
+    def create(day, hour=None):
+        '''
+        Creates a new, unsaved, one hour Event for the user to fill in.
+
+        :param day: Date
+        :type day: date
+
+        :param hour: Start hour, defaults to the current hour
+        :type hour: int
+
+        :returns Event: The Event
+        '''
+        if hour is None:
+            hour = datetime.now().hour
+        start = datetime(day.year, day.month, day.day, hour)
+        event = Event()
+        event.set_start(start)
+        event.set_end(start + timedelta(hours=1))
+        return event
+
+    @staticmethod
+    def to_timestamp(moment):
+        '''
+        Encode a wall clock time as the number of seconds since
+        1970-01-01 00:00. Times are stored without a timezone so that events
+        stay at the same hour when the local timezone changes.
+
+        :param moment: Time
+        :type moment: datetime
+
+        :returns int: Timestamp
+        '''
+        delta = moment - Event.EPOCH
+        return delta.days * 86400 + delta.seconds
+
+    @staticmethod
+    def from_timestamp(timestamp):
+        '''
+        Decode a timestamp created by Event.to_timestamp
+
+        :param timestamp: Timestamp
+        :type timestamp: int
+
+        :returns datetime: Time
+        '''
+        return Event.EPOCH + timedelta(seconds=timestamp)
+
+    def get_date(self):
+        '''
+        Get the day the event starts on, from date or year, month and day.
+
+        :returns date: Date
+        '''
+        if isinstance(self.date, date):
+            return self.date
+        return date(int(self.year), int(self.month), int(self.day))
+
+    def get_start(self):
+        '''
+        Get the start of the event
+
+        :returns datetime: Start
+        '''
+        day = self.get_date()
+        return datetime(
+            day.year,
+            day.month,
+            day.day,
+            int(self.start_hour),
+            int(self.start_minute)
+        )
+
+    def get_end(self):
+        '''
+        Get the end of the event. An end time before the start time means
+        that the event ends on the following day.
+
+        :returns datetime: End
+        '''
+        day = self.get_date()
+        end = datetime(
+            day.year,
+            day.month,
+            day.day,
+            int(self.end_hour),
+            int(self.end_minute)
+        )
+        if end < self.get_start():
+            end = end + timedelta(1)
+        return end
+
+    def set_start(self, start):
+        '''
+        Set the day and time the event starts
+
+        :param start: Start
+        :type start: datetime
+        '''
+        self.date = start.date()
+        self.year = start.year
+        self.month = start.month
+        self.day = start.day
+        self.start_hour = start.hour
+        self.start_minute = start.minute
+
+    def set_end(self, end):
+        '''
+        Set the time the event ends. Should be less than a day after the
+        start.
+
+        :param end: End
+        :type end: datetime
+        '''
+        self.end_hour = end.hour
+        self.end_minute = end.minute
+
+    def set_rrule(self, rule, from_utc=None):
+        '''
+        Make the event recur. Occurrences are expanded when they are read,
+        only the event itself is stored.
+
+        :param rule: Rule, e.g. RRULE:FREQ=WEEKLY;BYDAY=MO. None to stop
+            recurring.
+        :type rule: str|None
+
+        :param from_utc: Converts the UTC times in the rule to local time
+            like the start of the event, see recurrence.normalize
+        :type from_utc: callable
+        '''
+        self.rrule = recurrence.normalize(rule, from_utc)
+
+    def is_occurrence(self):
+        '''
+        Check if this is a generated occurrence of a series, rather than the
+        stored event. Saving an occurrence moves the whole series.
+
+        :returns bool: True if it is an occurrence
+        '''
+        return bool(self.series_offset)
+
+    def split(self):
+        '''
+        Take an occurrence out of its series, e.g. to change only that one.
+        The series leaves out the start of the occurrence, which becomes an
+        event of its own, keyed like the changed occurrences an import
+        brings, see importer.get_uid. Save both with Event.save_many.
+
+        :returns tuple: The series and the new Event, both unsaved
+        '''
+        # Imported on first use to keep icalendar off the startup path
+        from exporter import to_utc
+
+        start = self.stored_start
+        series = self.copy()
+        series.series_offset = timedelta(0)
+        series.set_start(start - self.series_offset)
+        series.set_end(self.get_end() - self.series_offset)
+        series.rrule = recurrence.exclude(self.rrule, [start])
+        series.stored_start = series.get_start()
+        event = self.copy()
+        event.id = ''
+        event.is_saved = False
+        event.google_id = ''
+        event.rrule = None
+        event.series_offset = timedelta(0)
+        event.stored_start = None
+        event.stored_rrule = None
+        event.uid = None
+        if self.uid:
+            event.uid = self.uid + '#' + \
+                to_utc(start).strftime(recurrence.FORMAT + 'Z')
+        # Created here, see set_identity
+        event.source = None
+        event.content_hash = None
+        return series, event
+
+    def occur(self, start):
+        '''
+        Create the occurrence of this series that starts at a certain time
+
+        :param start: Start of the occurrence
+        :type start: datetime
+
+        :returns Event: The occurrence
+        '''
+        event = Event()
+        event.id = self.id
+        event.name = self.name
+        event.location = self.location
+        event.google_id = self.google_id
+        event.rrule = self.rrule
+        event.uid = self.uid
+        event.content_hash = self.content_hash
+        event.source = self.source
+        event.is_saved = self.is_saved
+        event.set_start(start)
+        event.end_hour = self.end_hour
+        event.end_minute = self.end_minute
+        event.series_offset = start - self.get_start()
+        event.stored_start = start
+        event.stored_rrule = self.rrule
+        return event
+
+    def copy(self):
+        '''
+        Copy the Event, e.g. to edit it without changing the one the caches
+        hand out
+
+        :returns Event: The copy
+        '''
+        event = Event()
+        for name in Event.__slots__:
+            setattr(event, name, getattr(self, name))
+        return event
 
     def pad_zero(self, value):
         return_value = str(value)
@@ -39,20 +839,8 @@ class Event:
             self.year = self.date.strftime('%Y')
             self.month = self.date.strftime('%m')
             self.day = self.date.strftime('%d')
-        start_string = '{}-{}-{}T{}:{}:00.000+02:00'.format(
-            self.year,
-            self.month,
-            self.day,
-            self.pad_zero(self.start_hour),
-            self.pad_zero(self.start_minute)
-        )
-        end_string = '{}-{}-{}T{}:{}:00.000+02:00'.format(
-            self.year,
-            self.month,
-            self.day,
-            self.pad_zero(self.end_hour),
-            self.pad_zero(self.end_minute)
-        )
+        start_string = self.get_start().strftime('%Y-%m-%dT%H:%M:00.000+02:00')
+        end_string = self.get_end().strftime('%Y-%m-%dT%H:%M:00.000+02:00')
         return {
             'start': {
                 'dateTime': start_string
@@ -74,11 +862,121 @@ class Event:
     def to_google(self):
         return self.get_google_object()
 
-    def overlaps(self, hour, minute):
-        start = self.start_hour + 100 * self.start_minute
-        end = self.end_hour + 100 * self.end_minute
-        overlap = hour + 100 * minute
-        return start < overlap and overlap < end
+    @staticmethod
+    def from_google(item):
+        '''
+        Get the Event for an item of the Google Calendar events list,
+        updated with the item. Events that were synced before are looked up
+        by their Google id, others are new and unsaved.
+
+        :param item: Event resource from the Google Calendar API
+        :type item: dict
+
+        :returns Event: Event
+        '''
+        # Imported on first use to keep dateutil off the startup path
+        from dateutil import parser
+
+        event = Event.get_by_google_id(item['id'])
+
+        if 'dateTime' in item['start']:
+            start_dt = parser.parse(item['start']['dateTime'])
+        else:
+            start_dt = parser.parse(item['start']['date'])
+
+        if 'dateTime' in item['end']:
+            end_dt = parser.parse(item['end']['dateTime'])
+            event.end_hour = end_dt.hour
+            event.end_minute = end_dt.minute
+        else:
+            end_dt = parser.parse(item['end']['date'])
+            event.end_hour = 23
+            event.end_minute = 59
+
+        event.set_start(start_dt)
+
+        event.google_id = item['id']
+        event.name = item['summary']
+        rules = [line for line in item.get('recurrence', [])
+                 if line.startswith(('RRULE:', 'EXDATE'))]
+        # The start is kept in the timezone Google gave it in
+        offset = start_dt.utcoffset()
+        event.set_rrule(
+            '\n'.join(rules),
+            None if offset is None else lambda moment: moment + offset
+        )
+        if 'location' in item:
+            event.location = item['location']
+        return event
+
+    @staticmethod
+    def import_google(service, calendar_id):
+        '''
+        Fetch the events of a Google Calendar and save them, see
+        Event.from_google. Moved and cancelled occurrences come as separate
+        items, they are left out of their series.
+
+        :param service: Google Calendar API service
+        :type service: googleapiclient.discovery.Resource
+
+        :param calendar_id: Id of the calendar
+        :type calendar_id: str
+
+        :returns int: Number of events saved
+        '''
+        # Imported on first use to keep dateutil off the startup path
+        from dateutil import parser
+
+        request = service.events().list(calendarId=calendar_id)
+        events = request.execute()
+
+        imported = []
+        # Starts of the replaced occurrences per series Google id
+        replaced = {}
+        for item in events['items']:
+            if 'recurringEventId' in item and 'originalStartTime' in item:
+                original = item['originalStartTime']
+                start = parser.parse(
+                    original.get('dateTime') or original['date']
+                )
+                replaced.setdefault(item['recurringEventId'], []).append(
+                    start.replace(tzinfo=None)
+                )
+            if item.get('status') != 'cancelled':
+                imported.append(Event.from_google(item))
+        Event.save_many(imported)
+        Event.exclude_starts('google_id', replaced)
+        return len(imported)
+
+    def overlaps(self, start, end):
+        '''
+        Checks if the event overlaps a time window. To check many events at
+        once use Event.build_index.
+
+        :param start: Start of the window, inclusive
+        :type start: datetime
+
+        :param end: End of the window, exclusive
+        :type end: datetime
+
+        :returns bool: True if they overlap
+        '''
+        return self.get_start() < end and start < self.get_end()
+
+    @staticmethod
+    def build_index(events):
+        '''
+        Build an index over loaded events for overlap and point in time
+        queries by start and end.
+
+        :param events: Events
+        :type events: list[Event]
+
+        :returns IntervalIndex: Index returning Events
+        '''
+        return IntervalIndex([
+            (event.get_start(), event.get_end(), event) for event in events
+        ])
 
     def echo(self):
         '''
@@ -97,15 +995,194 @@ class Event:
         print 'Month:', self.month
         print 'Day:', self.day
 
+    COLUMNS = (
+        'id',
+        'name',
+        'location',
+        'starts_at',
+        'ends_at',
+        'google_id',
+        'rrule',
+        'uid',
+        'content_hash',
+        'source',
+    )
+
     @staticmethod
-    def get_by_google_id(id):
+    def from_row(row):
+        '''
+        Hydrate an Event from a row selected with Event.COLUMNS
+
+        :param row: Row
+        :type row: tuple
+
+        :returns Event: The Event
+        '''
+        event = Event()
+        event.id = row[0]
+        event.name = row[1]
+        event.location = row[2]
+        event.google_id = row[5] or ''
+        event.rrule = row[6]
+        event.uid = row[7]
+        event.content_hash = row[8]
+        event.source = row[9]
+        event.is_saved = True
+        # Decode the timestamps by hand, this runs for every loaded event
+        days, seconds = divmod(row[3], 86400)
+        event.date = date.fromordinal(Event.EPOCH_ORDINAL + days)
+        event.year = event.date.year
+        event.month = event.date.month
+        event.day = event.date.day
+        event.start_hour, seconds = divmod(seconds, 3600)
+        event.start_minute = seconds // 60
+        event.end_hour, seconds = divmod(row[4] % 86400, 3600)
+        event.end_minute = seconds // 60
+        event.stored_start = Event.EPOCH + timedelta(seconds=row[3])
+        event.stored_rrule = event.rrule
+        return event
+
+    @staticmethod
+    def select(where='', values=()):
+        '''
+        Fetch and hydrate all Events matching a where clause in one query
+
+        :param where: SQL following "where", empty for all rows
+        :type where: str
+
+        :param values: Values for the placeholders in where
+        :type values: tuple
+
+        :returns list[Event]: List of Events
+        '''
         cursor = Event.get_connection().cursor()
-        sql = 'select id from events where google_id = ?'
-        cursor.execute(sql, (id,))
-        row = cursor.fetchone()
-        if row is None:
+        sql = 'select {} from events'.format(', '.join(Event.COLUMNS))
+        if where:
+            sql = sql + ' where ' + where
+        sql = sql + ' order by starts_at'
+        cursor.execute(sql, values)
+        return [Event.from_row(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def stream(where='', values=(), size=500):
+        '''
+        Like Event.select, but fetch the rows in chunks while they are used,
+        so that any number of events can be walked through. Uses the
+        connection of the current thread and leaves the caches alone.
+
+        :param where: SQL following "where", empty for all rows
+        :type where: str
+
+        :param values: Values for the placeholders in where
+        :type values: tuple
+
+        :param size: Number of rows to fetch at once
+        :type size: int
+
+        :returns generator: Events
+        '''
+        cursor = Event.get_connection().cursor()
+        sql = 'select {} from events'.format(', '.join(Event.COLUMNS))
+        if where:
+            sql = sql + ' where ' + where
+        sql = sql + ' order by starts_at'
+        cursor.execute(sql, values)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            for row in rows:
+                yield Event.from_row(row)
+
+    @staticmethod
+    def get_match(query):
+        '''
+        Turn text entered by the user into a full text query in which every
+        word has to match the start of a word in the event
+
+        :param query: Text entered by the user
+        :type query: str
+
+        :returns str|None: Query for events_search, None if there are no
+            words in the text
+        '''
+        terms = ['"{}"*'.format(term.replace('"', '""'))
+                 for term in query.split()]
+        if not terms:
+            return None
+        return ' '.join(terms)
+
+    @staticmethod
+    def search(query, limit=20):
+        '''
+        Find events by name or location. Every word in the query has to
+        match the start of a word in the event, best matches come first.
+
+        :param query: Text entered by the user
+        :type query: str
+
+        :param limit: Maximum number of events
+        :type limit: int
+
+        :returns list[Event]: List of Events
+        '''
+        match = Event.get_match(query)
+        if match is None:
+            return []
+        cursor = Event.get_connection().cursor()
+        sql = 'select {} from events \
+                join events_search on events_search.rowid = events.id \
+                where events_search match ? \
+                order by rank \
+                limit ?'.format(
+            ', '.join('events.' + column for column in Event.COLUMNS)
+        )
+        cursor.execute(sql, (match, limit))
+        return [Event.from_row(row) for row in cursor.fetchall()]
+
+    @staticmethod
+    def rebuild_search_index():
+        '''
+        Rebuild the full text index from scratch, e.g. after the events
+        table was changed by hand.
+        '''
+        connection = Event.get_connection()
+        connection.cursor().execute(
+            "insert into events_search (events_search) values ('rebuild')"
+        )
+        connection.commit()
+
+    @staticmethod
+    def get_by_google_id(id):
+        events = Event.select('google_id = ?', (id,))
+        if not events:
             return Event()
-        return Event.get_by_id(row[0])
+        return events[0]
+
+    @staticmethod
+    def get_imported(uids):
+        '''
+        Look up which of a number of UIDs were imported before
+
+        :param uids: UIDs
+        :type uids: list[str]
+
+        :returns dict[str, tuple]: Id, content hash and Google id of the
+            event per UID, UIDs that were never imported are left out
+        '''
+        cursor = Event.get_connection().cursor()
+        imported = {}
+        # Stay below the limit on the number of placeholders
+        for i in range(0, len(uids), 500):
+            chunk = uids[i:i + 500]
+            cursor.execute(
+                'select uid, id, content_hash, google_id from events \
+                    where uid in ({})'.format(', '.join('?' * len(chunk))),
+                tuple(chunk)
+            )
+            for uid, id, content_hash, google_id in cursor.fetchall():
+                imported[uid] = (id, content_hash, google_id)
+        return imported
 
     @staticmethod
     def get_by_id(id):
@@ -117,36 +1194,15 @@ class Event:
 
         :returns Event: The Event
         '''
-        cursor = Event.get_connection().cursor()
-        sql = 'select \
-                name, \
-                location, \
-                year, \
-                month, \
-                day, \
-                start_hour, \
-                start_minute, \
-                end_hour, \
-                end_minute, \
-                google_id \
-            from events where id = ?'
-        cursor.execute(sql, (str(id),))
-        row = cursor.fetchone()
-
-        event = Event()
-        event.id = id
-        event.name = row[0]
-        event.location = row[1]
-        event.year = int(row[2])
-        event.month = int(row[3])
-        event.day = int(row[4])
-        event.start_hour = int(row[5])
-        event.start_minute = int(row[6])
-        event.end_hour = int(row[7])
-        event.end_minute = int(row[8])
-        event.google_id = str(row[9])
-        event.is_saved = True
-        event.date = date(event.year, event.month, event.day)
+        Event.sync_cache()
+        with Event.lock:
+            event = Event.cache.get(int(id))
+            version = Event.cache.version
+        if event is None:
+            event = Event.select('id = ?', (str(id),))[0]
+            with Event.lock:
+                if Event.cache.version == version:
+                    Event.cache.add(event)
         return event
 
     @staticmethod
@@ -156,31 +1212,19 @@ class Event:
 
         :returns list[Event]: List of Events
         '''
-        cursor = Event.get_connection().cursor()
-        cursor.execute('select id from events')
-        rows = cursor.fetchall()
-        objects = []
-        for row in rows:
-            objects.append(Event.get_by_id(row[0]))
-        return objects
+        return Event.select()
 
     @staticmethod
     def get_by_hour(year, month, day, hour):
-        cursor = Event.get_connection().cursor()
-        sql = 'select id \
-                from events \
-                where year = ? and month = ? and day = ? and start_hour = ?'
-        cursor.execute(sql, (year, month, day, hour))
-        rows = cursor.fetchall()
-        objects = []
-        for row in rows:
-            objects.append(Event.get_by_id(row[0]))
-        return objects
+        events = Event.get_by_day(year, month, day)
+        return [event for event in events if event.start_hour == int(hour)]
 
     @staticmethod
     def get_by_day(year, month, day):
         '''
-        Get all events on a certain day.
+        Get all events on a certain day. The query runs outside of
+        Event.lock, so its result is only cached if nothing was removed from
+        the cache meanwhile, it might be outdated otherwise.
 
         :param year: Year
         :type year: int
@@ -193,50 +1237,556 @@ class Event:
 
         :returns list[Event]: List of Events
         '''
+        day = date(int(year), int(month), int(day))
+        Event.sync_cache()
+        with Event.lock:
+            events = Event.cache.get_day(day)
+            version = Event.cache.version
+        if events is None:
+            events = Event.get_starting(
+                datetime(day.year, day.month, day.day),
+                datetime(day.year, day.month, day.day) + timedelta(1)
+            )
+            with Event.lock:
+                if Event.cache.version == version:
+                    Event.cache.add_day(day, events)
+        return events
+
+    @staticmethod
+    def get_starting(start, end):
+        '''
+        Get all events starting in a time window, as one range scan over
+        events_starts_at.
+
+        :param start: Start of the window, inclusive
+        :type start: datetime
+
+        :param end: End of the window, exclusive
+        :type end: datetime
+
+        :returns list[Event]: List of Events, ordered by start
+        '''
+        events = Event.select(
+            'starts_at >= ? and starts_at < ? and rrule is null',
+            (Event.to_timestamp(start), Event.to_timestamp(end))
+        )
+        occurrences = Event.get_occurrences(start, end)
+        if not occurrences:
+            return events
+        return sorted(events + occurrences, key=Event.get_start)
+
+    @staticmethod
+    def get_series(start, end):
+        '''
+        Get the recurring events that can occur in a time window: their
+        series starts before its end and is not over before its start
+
+        :param start: Start of the window, inclusive
+        :type start: datetime
+
+        :param end: End of the window, exclusive
+        :type end: datetime
+
+        :returns list[Event]: List of Events
+        '''
+        return Event.select(
+            'rrule is not null and starts_at < ? and \
+                (last_starts_at is null or last_starts_at >= ?)',
+            (Event.to_timestamp(end), Event.to_timestamp(start))
+        )
+
+    @staticmethod
+    def get_occurrences(start, end):
+        '''
+        Expand the recurring events into their occurrences starting in a
+        time window. Expansions are memoized in Event.recurrences.
+
+        :param start: Start of the window, inclusive
+        :type start: datetime
+
+        :param end: End of the window, exclusive
+        :type end: datetime
+
+        :returns list[Event]: List of occurrences
+        '''
+        occurrences = []
+        series_list = Event.get_series(start, end)
+        with Event.lock:
+            for series in series_list:
+                starts = Event.recurrences.get_starts(
+                    series.rrule,
+                    series.get_start(),
+                    start,
+                    end
+                )
+                occurrences.extend(series.occur(moment) for moment in starts)
+        return occurrences
+
+    @staticmethod
+    def get_between(start, end):
+        '''
+        Get all events overlapping a time window, including those that
+        started before it.
+
+        :param start: Start of the window, inclusive
+        :type start: datetime
+
+        :param end: End of the window, exclusive
+        :type end: datetime
+
+        :returns list[Event]: List of Events, ordered by start
+        '''
+        events = Event.select(
+            'starts_at < ? and ends_at > ? and rrule is null',
+            (Event.to_timestamp(end), Event.to_timestamp(start))
+        )
+        # Events are shorter than a day, so earlier occurrences can not
+        # reach into the window
+        occurrences = [
+            event for event in Event.get_occurrences(start - timedelta(1), end)
+            if event.overlaps(start, end)
+        ]
+        if not occurrences:
+            return events
+        return sorted(events + occurrences, key=Event.get_start)
+
+    @staticmethod
+    def get_day_counts(start_date, end_date):
+        '''
+        Get the number of events per day between two dates in one query,
+        without loading the events themselves.
+
+        :param start_date: First day, inclusive
+        :type start_date: date
+
+        :param end_date: Last day, inclusive
+        :type end_date: date
+
+        :returns dict[date, int]: Number of events per day. Every day in the
+            range is present.
+        '''
+        counts = {}
+        current = start_date
+        while current <= end_date:
+            counts[current] = 0
+            current = current + timedelta(1)
+        cursor = Event.get_connection().cursor()
+        sql = 'select day, count from day_counts where day between ? and ?'
+        values = (Event.day_key(start_date), Event.day_key(end_date))
+        cursor.execute(sql, values)
+        for key, count in cursor.fetchall():
+            counts[date(key // 10000, key // 100 % 100, key % 100)] = count
+        # Occurrences of recurring events are not stored, add them here
+        start = datetime(start_date.year, start_date.month, start_date.day)
+        end = datetime(end_date.year, end_date.month, end_date.day) + \
+            timedelta(1)
+        series_list = Event.get_series(start, end)
+        with Event.lock:
+            for series in series_list:
+                starts = Event.recurrences.get_starts(
+                    series.rrule,
+                    series.get_start(),
+                    start,
+                    end
+                )
+                for moment in starts:
+                    counts[moment.date()] = counts[moment.date()] + 1
+        return counts
+
+    @staticmethod
+    def day_key(day):
+        '''
+        Encode a date the way day_counts does, e.g. 20160301
+
+        :param day: Date
+        :type day: date
+
+        :returns int: Key
+        '''
+        return day.year * 10000 + day.month * 100 + day.day
+
+    @staticmethod
+    def get_range(start_date, end_date):
+        '''
+        Get all events between two dates in one query, bucketed by day.
+
+        :param start_date: First day, inclusive
+        :type start_date: date
+
+        :param end_date: Last day, inclusive
+        :type end_date: date
+
+        :returns dict[date, list[Event]]: Events per day. Every day in the
+            range is present, days without events map to an empty list.
+        '''
+        days = {}
+        current = start_date
+        while current <= end_date:
+            days[current] = []
+            current = current + timedelta(1)
+        Event.sync_cache()
+        with Event.lock:
+            cached = Event.cache.get_days(days.keys())
+            version = Event.cache.version
+        if cached is not None:
+            return cached
+        events = Event.get_starting(
+            datetime(start_date.year, start_date.month, start_date.day),
+            datetime(end_date.year, end_date.month, end_date.day) +
+            timedelta(1)
+        )
+        for event in events:
+            days[event.date].append(event)
+        # See get_by_day
+        with Event.lock:
+            if Event.cache.version == version:
+                for day in sorted(days.keys()):
+                    Event.cache.add_day(day, days[day])
+        return days
+
+    @staticmethod
+    def get_changes(since=0):
+        '''
+        Get the changes made to events after a certain point of the journal
+
+        :param since: Sequence number of the last change already seen
+        :type since: int
+
+        :returns list[Change]: Changes, oldest first
+        '''
         cursor = Event.get_connection().cursor()
-        sql = 'select id from events where year = ? and month = ? and day = ?'
-        cursor.execute(sql, (year, month, day))
-        rows = cursor.fetchall()
-        objects = []
-        for row in rows:
-            objects.append(Event.get_by_id(row[0]))
-        return objects
+        sql = 'select seq, event_id, op, changed_at from changes \
+                where seq > ? order by seq'
+        cursor.execute(sql, (since,))
+        return [Change(*row) for row in cursor.fetchall()]
 
     @staticmethod
+    def get_last_seq():
+        '''
+        Get the sequence number of the latest change in the journal
+
+        :returns int: Sequence number, 0 if nothing has changed yet
+        '''
+        cursor = Event.get_connection().cursor()
+        cursor.execute('select max(seq) from changes')
+        return cursor.fetchone()[0] or 0
+
+    @staticmethod
+    def sync_cache():
+        '''
+        Bring Event.cache up to date with changes made by other processes,
+        by dropping the changed events and the days they are on. Nothing is
+        changed if another thread synced the cache meanwhile.
+        '''
+        cache = Event.cache
+        with Event.lock:
+            seq = cache.seq
+        last_seq = Event.get_last_seq()
+        if seq is None:
+            with Event.lock:
+                if cache.seq is None:
+                    cache.seq = last_seq
+            return
+        # Do not even load the journal after big imports
+        if last_seq - seq > Event.MAX_SYNCED:
+            with Event.lock:
+                if cache.seq == seq:
+                    cache.clear()
+                    cache.seq = last_seq
+            return
+        changes = Event.get_changes(seq)
+        if not changes:
+            return
+        ids = list(set(change.event_id for change in changes))
+        events = None
+        # Checking every event separately is not worth it for big imports
+        if len(ids) <= Event.MAX_SYNCED:
+            events = Event.select(
+                'id in ({})'.format(', '.join('?' * len(ids))),
+                tuple(ids)
+            )
+        with Event.lock:
+            if cache.seq != seq:
+                return
+            if events is None:
+                cache.clear()
+            else:
+                for id in ids:
+                    cache.remove(id)
+                for event in events:
+                    cache.update(event)
+            cache.seq = changes[-1].seq
+
+    @staticmethod
+    @synchronized
     def connect():
         '''
-        Connect to the database and create the schema if it does not exist.
+        Connect to the database and create or upgrade the schema. Connections
+        that other threads opened before are replaced on their next use.
         '''
-        db_file = os.path.join(Event.CONFIG_DIR, 'events.db')
-        Event.connection = sqlite3.connect(db_file)
-        Event.connection.text_factory = str
+        Event.generation = Event.generation + 1
+        Event.cache.clear()
+        Event.recurrences.clear()
+        connection = Event.open_connection()
+        Event.migrate(connection)
+        Event.local.connection = connection
+        Event.local.generation = Event.generation
         Event.is_connected = True
-        sql = 'create table if not exists \
-            events ( \
-                id integer primary key, \
-                name text, \
-                location text, \
-                year int, \
-                month int, \
-                day int, \
-                start_hour int, \
-                start_minute int, \
-                end_hour int, \
-                end_minute int, \
-                google_id varchar(255) \
-            )'
-        Event.connection.cursor().execute(sql)
 
     @staticmethod
+    def open_connection():
+        '''
+        Open a new connection to the database. The database is kept in WAL
+        mode, so readers never block the writer and the writer never blocks
+        readers, also across processes. A writer waits up to BUSY_TIMEOUT
+        seconds for another writer before failing with "database is locked".
+        While profiling the statements are counted and timed, see profiler.
+
+        :returns sqlite3.Connection: Connection
+        '''
+        db_file = os.path.join(Event.CONFIG_DIR, 'events.db')
+        factory = Connection if Profiler.enabled else sqlite3.Connection
+        connection = sqlite3.connect(
+            db_file,
+            timeout=Event.BUSY_TIMEOUT,
+            factory=factory
+        )
+        connection.text_factory = str
+        connection.execute('pragma journal_mode = wal')
+        # Safe against corruption in WAL mode, a power loss can only undo
+        # the last transactions
+        connection.execute('pragma synchronous = normal')
+        return connection
+
+    @staticmethod
+    def get_schema_version(connection):
+        '''
+        Get the schema version of a database, 0 for a database that predates
+        versioning.
+
+        :param connection: Connection
+        :type connection: sqlite3.Connection
+
+        :returns int: Version
+        '''
+        cursor = connection.cursor()
+        cursor.execute('create table if not exists \
+            schema_version (version int not null)')
+        cursor.execute('select version from schema_version')
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute('insert into schema_version (version) values (0)')
+            return 0
+        return row[0]
+
+    @staticmethod
+    def get_columns(cursor, table):
+        '''
+        Get the names of the columns of a table
+
+        :param cursor: Cursor
+        :type cursor: sqlite3.Cursor
+
+        :param table: Name of the table
+        :type table: str
+
+        :returns list[str]: Names, empty if the table does not exist
+        '''
+        cursor.execute('pragma table_info({})'.format(table))
+        return [row[1] for row in cursor.fetchall()]
+
+    @staticmethod
+    def get_migration(cursor, version):
+        '''
+        Get the statements that bring the schema to the next version. Older
+        versions could be stopped halfway through migration 3, which is
+        continued where it stopped instead of starting over.
+
+        :param cursor: Cursor
+        :type cursor: sqlite3.Cursor
+
+        :param version: Current version
+        :type version: int
+
+        :returns tuple: Statements
+        '''
+        statements = Event.MIGRATIONS[version]
+        if version != 2:
+            return statements
+        columns = Event.get_columns(cursor, 'events')
+        if 'starts_at' in columns:
+            # events_v2 was renamed already
+            start = statements.index('alter table events_v2 rename to events')
+            return statements[start + 1:]
+        if not columns and Event.get_columns(cursor, 'events_v2'):
+            # events was dropped, events_v2 holds the only copy
+            start = statements.index('drop table events')
+            return statements[start + 1:]
+        return statements
+
+    @staticmethod
+    def migrate(connection):
+        '''
+        Run all migrations the database has not seen yet, in order. Every
+        migration runs in one transaction with its version bump, so a failed
+        migration leaves the database at the previous version. sqlite3
+        commits before DDL statements on its own, so the transactions are
+        managed here with the connection in autocommit mode.
+
+        :param connection: Connection
+        :type connection: sqlite3.Connection
+        '''
+        version = Event.get_schema_version(connection)
+        connection.commit()
+        if version >= len(Event.MIGRATIONS):
+            return
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        cursor = connection.cursor()
+        try:
+            while True:
+                cursor.execute('begin immediate')
+                try:
+                    # Another process may have migrated in the meantime
+                    version = Event.get_schema_version(connection)
+                    if version >= len(Event.MIGRATIONS):
+                        cursor.execute('commit')
+                        return
+                    for sql in Event.get_migration(cursor, version):
+                        if callable(sql):
+                            sql(cursor)
+                        else:
+                            cursor.execute(sql)
+                    cursor.execute(
+                        'update schema_version set version = ?',
+                        (version + 1,)
+                    )
+                    cursor.execute('commit')
+                except Exception:
+                    cursor.execute('rollback')
+                    raise
+        finally:
+            connection.isolation_level = isolation_level
+
+    @staticmethod
+    @synchronized
     def get_connection():
         '''
-        Ensure that we are connected to the database and return the connection
+        Ensure that we are connected to the database and return the
+        connection of the current thread. sqlite3 connections can not be
+        shared between threads, so each thread opens its own on first use
+        and it is closed when the thread ends.
 
         :returns sqlite3.Connection: Connection
         '''
         if not Event.is_connected:
             Event.connect()
-        return Event.connection
+        if getattr(Event.local, 'generation', None) != Event.generation:
+            Event.local.connection = Event.open_connection()
+            Event.local.generation = Event.generation
+        return Event.local.connection
+
+    INSERT_SQL = 'insert into events \
+            ( \
+                name, \
+                location, \
+                starts_at, \
+                ends_at, \
+                google_id, \
+                rrule, \
+                uid, \
+                content_hash, \
+                source, \
+                last_starts_at, \
+                id \
+            ) \
+            values \
+            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+    UPDATE_SQL = 'update events set \
+            name = ?, \
+            location = ?, \
+            starts_at = ?, \
+            ends_at = ?, \
+            google_id = ?, \
+            rrule = ?, \
+            uid = ?, \
+            content_hash = ?, \
+            source = ?, \
+            last_starts_at = ? \
+            where id = ?'
+
+    def get_values(self):
+        '''
+        Get the values to write for this event, in the order used by
+        Event.INSERT_SQL and Event.UPDATE_SQL
+
+        :returns tuple: Values
+        '''
+        if self.location is None:
+            self.location = ''
+        # Events read back from the database already hold bytes
+        location = self.location
+        if isinstance(location, unicode):
+            location = location.encode('utf-8')
+        start = self.get_start() - self.series_offset
+        last_starts_at = None
+        if self.rrule:
+            last_start = recurrence.get_last_start(self.rrule, start)
+            if last_start is not None:
+                last_starts_at = Event.to_timestamp(last_start)
+        return (
+            self.name,
+            location,
+            Event.to_timestamp(start),
+            Event.to_timestamp(self.get_end() - self.series_offset),
+            self.google_id or None,
+            self.rrule or None,
+            self.uid,
+            self.content_hash,
+            self.source,
+            last_starts_at,
+            self.id or None
+        )
+
+    def get_content_hash(self, replaced=()):
+        '''
+        Hash everything an import can change about the event, to tell
+        whether a re-imported event differs from the stored one
+
+        :param replaced: Starts the series leaves out because changed
+            occurrences replace them, see exporter.get_replaced
+        :type replaced: set[str]
+
+        :returns str: Hex digest
+        '''
+        rule = self.rrule and recurrence.canonical(self.rrule, replaced)
+        values = []
+        for value in self.get_values()[:4] + (rule,):
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            values.append(str(value))
+        return hashlib.sha1('\x1f'.join(values)).hexdigest()
+
+    def set_identity(self, pending=()):
+        '''
+        Give an event a UID if it has none yet. Events that were not
+        imported from a file also get the hash of their content, as imported
+        events have, so that importing an export of them again leaves them
+        unchanged, see importer.save_batch.
+
+        :param pending: Events that are saved along with this one
+        :type pending: list[Event]
+        '''
+        replaced = ()
+        if not self.uid:
+            self.uid = '{}@pjot-calendar'.format(os.urandom(16).encode('hex'))
+        elif self.rrule and self.source is None:
+            # Imported on first use to keep icalendar off the startup path
+            from exporter import get_replaced
+            replaced = get_replaced(self, pending)
+        if self.source is None:
+            self.content_hash = self.get_content_hash(replaced)
 
     def _create(self):
         '''
@@ -244,40 +1794,12 @@ class Event:
         '''
         connection = self.get_connection()
         cursor = connection.cursor()
-        if isinstance(self.date, date):
-            self.year = self.date.strftime('%Y')
-            self.month = self.date.strftime('%m')
-            self.day = self.date.strftime('%d')
-        sql = 'insert into events \
-                ( \
-                    name, \
-                    location, \
-                    year, \
-                    month, \
-                    day, \
-                    start_hour, \
-                    start_minute, \
-                    end_hour, \
-                    end_minute, \
-                    google_id \
-                ) \
-                values \
-                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
-        values = (
-            self.name,
-            self.location.encode('utf-8'),
-            self.year,
-            self.month,
-            self.day,
-            str(self.start_hour),
-            str(self.start_minute),
-            str(self.end_hour),
-            str(self.end_minute),
-            self.google_id
-        )
-        cursor.execute(sql, values)
+        cursor.execute(Event.INSERT_SQL, self.get_values())
         connection.commit()
         self.id = cursor.lastrowid
+        self.is_saved = True
+        with Event.lock:
+            Event.cache.update(self)
 
     def _update(self):
         '''
@@ -285,41 +1807,201 @@ class Event:
         '''
         connection = self.get_connection()
         cursor = connection.cursor()
-        sql = 'update events set \
-                name = ?, \
-                year = ?, \
-                month = ?, \
-                day = ?, \
-                start_hour = ?, \
-                start_minute = ?, \
-                end_hour = ?, \
-                end_minute = ?, \
-                location = ?, \
-                google_id = ? \
-                where id = ?'
-        values = (
-            self.name,
-            self.date.strftime('%Y'),
-            self.date.strftime('%m'),
-            self.date.strftime('%d'),
-            str(self.start_hour),
-            str(self.start_minute),
-            str(self.end_hour),
-            str(self.end_minute),
-            self.location.encode('utf-8'),
-            self.google_id,
-            self.id
-        )
-        cursor.execute(sql, values)
+        cursor.execute(Event.UPDATE_SQL, self.get_values())
         connection.commit()
+        with Event.lock:
+            Event.cache.update(self)
+
+    @staticmethod
+    def save_many(events, commit=True):
+        '''
+        Persists many Events in a single transaction. New events get their
+        ids assigned like with Event.save.
+
+        Without commit the transaction is left open, so that large imports
+        can write several batches at once. The caller then commits through
+        Event.get_connection on the same thread. The cache catches up
+        through the journal and no notices are published, so the caller has
+        to refresh the views itself.
+
+        :param events: Events
+        :type events: list[Event]
+
+        :param commit: Whether to commit the transaction
+        :type commit: bool
+        '''
+        connection = Event.get_connection()
+        cursor = connection.cursor()
+        # Changed occurrences that are split off along with their series
+        pending = [event for event in events
+                   if event.uid and '#' in event.uid]
+        for event in events:
+            event.set_identity(pending)
+        new_events = [event for event in events if not event.is_saved]
+        try:
+            cursor.executemany(
+                Event.UPDATE_SQL,
+                [event.get_values() for event in events if event.is_saved]
+            )
+            if new_events:
+                # The first insert takes the write lock, so the following
+                # ids can safely be handed out from its id
+                first = new_events[0]
+                cursor.execute(Event.INSERT_SQL, first.get_values())
+                first.id = cursor.lastrowid
+                for i, event in enumerate(new_events[1:]):
+                    event.id = first.id + i + 1
+                cursor.executemany(
+                    Event.INSERT_SQL,
+                    [event.get_values() for event in new_events[1:]]
+                )
+            if commit:
+                connection.commit()
+        except Exception:
+            connection.rollback()
+            for event in new_events:
+                event.id = ''
+            raise
+        for event in new_events:
+            event.is_saved = True
+        if not commit:
+            for event in events:
+                event.set_stored()
+            return
+        with Event.lock:
+            for event in events:
+                Event.cache.update(event)
+        notices = [event.get_notice() for event in events]
+        for event in events:
+            event.set_stored()
+        Event.publish(notices)
+
+    @staticmethod
+    def exclude_starts(column, excluded, commit=True):
+        '''
+        Leave occurrences out of series, e.g. because they were moved or
+        cancelled, see recurrence.exclude
+
+        :param column: Column the series are keyed by, uid or google_id
+        :type column: str
+
+        :param excluded: Starts of the occurrences to leave out per series
+        :type excluded: dict[str, list[datetime]]
+
+        :param commit: Whether to commit the transaction, see save_many
+        :type commit: bool
+        '''
+        keys = list(excluded)
+        changed = []
+        # Stay below the limit on the number of placeholders
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            series = Event.select(
+                'rrule is not null and {} in ({})'.format(
+                    column,
+                    ', '.join('?' * len(chunk))
+                ),
+                tuple(chunk)
+            )
+            for event in series:
+                rule = recurrence.exclude(
+                    event.rrule,
+                    excluded[getattr(event, column)]
+                )
+                if rule != event.rrule:
+                    event.rrule = rule
+                    changed.append(event)
+        if changed:
+            Event.save_many(changed, commit)
 
     def save(self):
         '''
         Persists the Event in the database.
         '''
-        if self.location is None:
-            self.location = ''
+        self.set_identity()
         if self.is_saved:
             self._update()
         else:
             self._create()
+        notice = self.get_notice()
+        self.set_stored()
+        Event.publish([notice])
+
+    def delete(self):
+        '''
+        Removes the Event from the database. Deleting an occurrence deletes
+        the whole series.
+        '''
+        connection = self.get_connection()
+        cursor = connection.cursor()
+        cursor.execute('delete from events where id = ?', (self.id,))
+        connection.commit()
+        with Event.lock:
+            Event.cache.remove(self.id)
+            if self.rrule:
+                Event.cache.clear_days()
+        notice = Notice(
+            self.id,
+            self.stored_start,
+            None,
+            bool(self.rrule or self.stored_rrule)
+        )
+        self.is_saved = False
+        self.id = ''
+        self.stored_start = None
+        self.stored_rrule = None
+        Event.publish([notice])
+
+    def get_notice(self):
+        '''
+        Describe how saving this event changes the stored one
+
+        :returns Notice: The Notice
+        '''
+        return Notice(
+            self.id,
+            self.stored_start,
+            self.get_start(),
+            bool(self.rrule or self.stored_rrule)
+        )
+
+    def set_stored(self):
+        '''
+        Remember the start and rule that were just written
+        '''
+        self.stored_start = self.get_start()
+        self.stored_rrule = self.rrule
+
+    @staticmethod
+    def subscribe(callback):
+        '''
+        Call a function with a list of Notices whenever events are saved or
+        deleted through this process.
+
+        :param callback: Function taking a list[Notice]
+        :type callback: callable
+        '''
+        Event.subscribers.append(callback)
+
+    @staticmethod
+    def unsubscribe(callback):
+        '''
+        Stop calling a function passed to Event.subscribe
+
+        :param callback: Function
+        :type callback: callable
+        '''
+        Event.subscribers.remove(callback)
+
+    @staticmethod
+    def publish(notices):
+        '''
+        Pass Notices on to every subscriber
+
+        :param notices: Notices
+        :type notices: list[Notice]
+        '''
+        if not notices:
+            return
+        for callback in list(Event.subscribers):
+            callback(notices)
@@ -0,0 +1,213 @@
+'''
+Module for exporting events to iCalendar files
+'''
+from datetime import timedelta, datetime
+from icalendar import Event as Component, vRecur
+from icalendar.prop import vDDDTypes
+from event import Event
+
+import recurrence
+import importer
+import pytz
+import time
+import re
+
+
+HEADER = 'BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//pjot//calendar//EN\r\n'
+FOOTER = 'END:VCALENDAR\r\n'
+
+
+def to_utc(moment):
+    '''
+    Convert a stored local wall clock time to UTC, the reverse of
+    importer.from_utc so that exported files import to the same events
+
+    :param moment: Local time
+    :type moment: datetime
+
+    :returns datetime: Time in UTC
+    '''
+    moment = moment + timedelta(seconds=time.timezone) - timedelta(hours=1)
+    return pytz.utc.localize(moment)
+
+
+def to_utc_rule(rule):
+    '''
+    Convert the floating UNTIL of a stored rule to UTC, as RFC 5545 requires
+    next to a DTSTART in UTC
+
+    :param rule: Value of an RRULE, e.g. FREQ=WEEKLY;UNTIL=20161231T080000
+    :type rule: str
+
+    :returns str: Value
+    '''
+    return re.sub(
+        r'UNTIL=(\d{8}T\d{6})(?!Z)',
+        lambda match: 'UNTIL=' + to_utc(
+            datetime.strptime(match.group(1), recurrence.FORMAT)
+        ).strftime(recurrence.FORMAT + 'Z'),
+        rule
+    )
+
+
+def get_replaced(event, pending=()):
+    '''
+    Get the starts of the occurrences of a series that changed occurrences
+    replace. Their RECURRENCE-ID already leaves them out of the series, so
+    they are not written as EXDATE and importing the file again leaves the
+    series unchanged.
+
+    :param event: Event
+    :type event: Event
+
+    :param pending: Events that are about to be saved along with the series
+    :type pending: list[Event]
+
+    :returns set[str]: Starts, formatted as in a rule
+    '''
+    if not event.rrule or not event.uid:
+        return set()
+    # See importer.get_uid for how changed occurrences are keyed
+    others = Event.select(
+        'uid > ? and uid < ?',
+        (event.uid + '#', event.uid + '$')
+    )
+    starts = set()
+    for other in others + list(pending):
+        replaced = importer.get_replaced(other.uid)
+        if replaced is not None and replaced[0] == event.uid:
+            starts.add(replaced[1].strftime(recurrence.FORMAT))
+    return starts
+
+
+def to_component(event, stamp):
+    '''
+    Create a VEVENT from an Event
+
+    :param event: Event
+    :type event: Event
+
+    :param stamp: Time of the export
+    :type stamp: datetime
+
+    :returns icalendar.Event: VEVENT
+    '''
+    component = Component()
+    uid = event.uid
+    # See importer.get_uid for how changed occurrences are keyed
+    base, __, recurrence_id = uid.rpartition('#')
+    try:
+        recurrence_id = vDDDTypes.from_ical(recurrence_id) if base else None
+    except ValueError:
+        recurrence_id = None
+    if recurrence_id is not None:
+        uid = base
+    component.add('uid', uid)
+    component.add('dtstamp', stamp)
+    if recurrence_id is not None:
+        component.add('recurrence-id', recurrence_id)
+    component.add('summary', event.name or '')
+    if event.location:
+        component.add('location', event.location)
+    component.add('dtstart', to_utc(event.get_start()))
+    component.add('dtend', to_utc(event.get_end()))
+    replaced = get_replaced(event)
+    for line in (event.rrule or '').splitlines():
+        name, __, value = line.partition(':')
+        if name == 'EXDATE':
+            moments = [moment for moment in value.split(',')
+                       if moment not in replaced]
+            if moments:
+                component.add('exdate', [
+                    to_utc(datetime.strptime(moment, recurrence.FORMAT))
+                    for moment in moments
+                ])
+        else:
+            component.add('rrule', vRecur.from_ical(to_utc_rule(value)))
+    return component
+
+
+def get_events(start_date=None, end_date=None, query=None):
+    '''
+    Stream the events to export from the database, ordered by start
+
+    :param start_date: First day, inclusive
+    :type start_date: date
+
+    :param end_date: Last day, inclusive
+    :type end_date: date
+
+    :param query: Only export events that match this search, see
+        Event.search
+    :type query: str
+
+    :returns generator: Events, series once with their rule
+    '''
+    clauses = []
+    values = []
+    window_start = datetime.min
+    window_end = datetime.max
+    if start_date is not None:
+        window_start = datetime.combine(start_date, datetime.min.time())
+        clauses.append('(starts_at >= ? or rrule is not null)')
+        values.append(Event.to_timestamp(window_start))
+    if end_date is not None:
+        window_end = datetime.combine(end_date, datetime.min.time()) + \
+            timedelta(1)
+        clauses.append('starts_at < ?')
+        values.append(Event.to_timestamp(window_end))
+    if query is not None:
+        match = Event.get_match(query)
+        if match is None:
+            return
+        clauses.append('id in (select rowid from events_search \
+            where events_search match ?)')
+        values.append(match)
+    for event in Event.stream(' and '.join(clauses), tuple(values)):
+        # Series that started before the range need an occurrence in it
+        if event.rrule and event.get_start() < window_start:
+            with Event.lock:
+                starts = Event.recurrences.get_starts(
+                    event.rrule,
+                    event.get_start(),
+                    window_start,
+                    window_end
+                )
+            if not starts:
+                continue
+        yield event
+
+
+def export_events(out, events):
+    '''
+    Write events as an iCalendar file, one event at a time
+
+    :param out: File to write to
+    :type out: file
+
+    :param events: Events
+    :type events: iterable
+
+    :returns int: Number of events written
+    '''
+    stamp = pytz.utc.localize(datetime.utcnow())
+    count = 0
+    out.write(HEADER)
+    for event in events:
+        out.write(to_component(event, stamp).to_ical())
+        count = count + 1
+    out.write(FOOTER)
+    return count
+
+
+def export_file(path, start_date=None, end_date=None, query=None):
+    '''
+    Export events to an iCalendar file, see get_events for the filters
+
+    :param path: Path to the file
+    :type path: str
+
+    :returns int: Number of events written
+    '''
+    with open(path, 'w') as out:
+        return export_events(out, get_events(start_date, end_date, query))
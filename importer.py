@@ -0,0 +1,501 @@
+'''
+Module for importing events from iCalendar files
+'''
+from collections import namedtuple
+from datetime import timedelta, datetime
+from icalendar import Event as Component
+from icalendar.prop import vDDDTypes
+from event import Event
+
+import multiprocessing
+import recurrence
+import time
+import os
+
+
+# Number of events written at once
+BATCH_SIZE = 1000
+
+# Outcome of an import, see import_events
+Imported = namedtuple('Imported', ('added', 'updated', 'unchanged', 'deleted'))
+
+
+def read_components(ics_file, name='VEVENT'):
+    '''
+    Read the components of a type from an iCalendar file one at a time.
+    Only the lines of the current component are kept in memory, so the size
+    of the file does not matter.
+
+    :param ics_file: Open iCalendar file
+    :type ics_file: file
+
+    :param name: Type of the components, e.g. VEVENT
+    :type name: str
+
+    :returns generator: icalendar Components
+    '''
+    begin = 'BEGIN:' + name
+    end = 'END:' + name
+    lines = None
+    for line in ics_file:
+        # Folded lines start with whitespace, so boundaries can be
+        # recognised without unfolding
+        content = line.rstrip('\r\n').upper()
+        if lines is None:
+            if content == begin:
+                lines = [line]
+            continue
+        lines.append(line)
+        if content == end:
+            yield Component.from_ical(''.join(lines))
+            lines = None
+
+
+def get_uid(component):
+    '''
+    Get the key an imported VEVENT is recognised by on a re-import. Changed
+    occurrences of a series share the UID of the series, so their
+    RECURRENCE-ID is added.
+
+    :param component: VEVENT
+    :type component: icalendar.Event
+
+    :returns str|None: Key, None if the VEVENT has no UID
+    '''
+    uid = component.get('uid')
+    if not uid:
+        return None
+    uid = uid.encode('utf-8')
+    if component.get('recurrence-id') is not None:
+        uid = uid + '#' + component.get('recurrence-id').to_ical()
+    return uid
+
+
+def from_utc(moment):
+    '''
+    Convert a time from an iCalendar file to the local wall clock time that
+    events are stored in, see exporter.to_utc for the reverse
+
+    :param moment: Time
+    :type moment: datetime
+
+    :returns datetime: Local time
+    '''
+    return moment - timedelta(seconds=time.timezone) + timedelta(hours=1)
+
+
+def to_local(moment):
+    '''
+    Convert a DATE or DATE-TIME of a VEVENT to the local time events are
+    stored in, a DATE becomes midnight
+
+    :param moment: Date or time
+    :type moment: date|datetime
+
+    :returns datetime: Local time
+    '''
+    if not isinstance(moment, datetime):
+        moment = datetime.combine(moment, datetime.min.time())
+    return from_utc(moment)
+
+
+def get_exdate(component):
+    '''
+    Get the starts a series of a VEVENT leaves out as an EXDATE line in
+    local time
+
+    :param component: VEVENT
+    :type component: icalendar.Event
+
+    :returns str|None: Line, None if it leaves nothing out
+    '''
+    exdates = component.get('exdate')
+    if not exdates:
+        return None
+    if not isinstance(exdates, list):
+        exdates = [exdates]
+    values = set(
+        to_local(value.dt).strftime(recurrence.FORMAT)
+        for exdate in exdates for value in exdate.dts
+    )
+    return 'EXDATE:' + ','.join(sorted(values))
+
+
+def get_replaced(uid):
+    '''
+    Get the occurrence a changed occurrence replaces, see get_uid
+
+    :param uid: Key of an imported event
+    :type uid: str
+
+    :returns tuple|None: UID of the series and local start of the occurrence
+        it replaces, None if the event does not replace one
+    '''
+    if not uid or '#' not in uid:
+        return None
+    base, __, recurrence_id = uid.rpartition('#')
+    try:
+        return base, to_local(vDDDTypes.from_ical(recurrence_id))
+    except ValueError:
+        return None
+
+
+def to_event(component, source=None):
+    '''
+    Create an Event from a VEVENT. Times are converted with from_utc. The
+    DATE of an all day event is taken as midnight and converted the same way,
+    so it keeps the offset of from_utc, e.g. 01:00 with TZ=UTC. Events store
+    only the hour they end, so an all day event ends when it starts.
+
+    :param component: VEVENT
+    :type component: icalendar.Event
+
+    :param source: Where the VEVENT comes from, e.g. the path of the file
+    :type source: str
+
+    :returns Event: Unsaved Event
+    '''
+    start = component.get('dtstart').dt
+    if component.get('dtend') is not None:
+        end = component.get('dtend').dt
+    elif component.get('duration') is not None:
+        end = start + component.get('duration').dt
+    else:
+        end = start
+    event = Event()
+    event.name = component.get('summary')
+    event.location = component.get('location')
+    event.set_start(to_local(start))
+    event.set_end(to_local(end))
+    if component.get('rrule'):
+        lines = ['RRULE:' + component.get('rrule').to_ical()]
+        exdate = get_exdate(component)
+        if exdate is not None:
+            lines.append(exdate)
+        event.set_rrule('\n'.join(lines), from_utc)
+    event.uid = get_uid(component)
+    event.source = source
+    return event
+
+
+def read_events(ics_file, source=None):
+    '''
+    Read the events from an iCalendar file one at a time
+
+    :param ics_file: Open iCalendar file
+    :type ics_file: file
+
+    :param source: Where the file comes from, see to_event
+    :type source: str
+
+    :returns generator: Unsaved Events
+    '''
+    for component in read_components(ics_file):
+        yield to_event(component, source)
+
+
+def save_batch(batch, counts, track=False):
+    '''
+    Save a batch of imported events without committing. Events with a UID
+    that was imported before are only written when their content changed,
+    and keep the Google id they were exported with.
+
+    :param batch: Events
+    :type batch: list[Event]
+
+    :param counts: Number of events per field of Imported, updated in place
+    :type counts: dict[str, int]
+
+    :param track: Whether to remember the UIDs in the imported table
+    :type track: bool
+
+    :returns list[int]: Ids of the events that were added or updated
+    '''
+    # Later duplicates of a UID win
+    keyed = dict((event.uid, event) for event in batch if event.uid)
+    events = [event for event in batch if not event.uid]
+    counts['added'] = counts['added'] + len(events)
+    imported = Event.get_imported(keyed.keys())
+    for uid, event in keyed.items():
+        event.content_hash = event.get_content_hash()
+        if uid not in imported:
+            counts['added'] = counts['added'] + 1
+            events.append(event)
+            continue
+        id, content_hash, google_id = imported[uid]
+        if content_hash == event.content_hash:
+            counts['unchanged'] = counts['unchanged'] + 1
+            continue
+        counts['updated'] = counts['updated'] + 1
+        event.id = id
+        event.google_id = google_id or ''
+        event.is_saved = True
+        events.append(event)
+    Event.save_many(events, commit=False)
+    if track:
+        Event.get_connection().executemany(
+            'insert or ignore into imported (uid) values (?)',
+            [(uid,) for uid in keyed]
+        )
+    return [event.id for event in events]
+
+
+def export_saved(ids, export, size=500):
+    '''
+    Pass saved events to an export function and store the Google ids it
+    hands out. Runs after the import is committed, so that the database is
+    not locked while the export waits for the network and nothing is
+    exported for an import that is rolled back. The ids are written in a
+    short transaction per chunk of events, also when the export fails
+    halfway.
+
+    :param ids: Ids of the events
+    :type ids: list[int]
+
+    :param export: Called with every event, e.g. Google.export_event
+    :type export: callable
+
+    :param size: Number of events to load and write at once
+    :type size: int
+    '''
+    connection = Event.get_connection()
+    for i in range(0, len(ids), size):
+        chunk = ids[i:i + size]
+        exported = []
+        try:
+            for event in Event.select(
+                'id in ({})'.format(', '.join('?' * len(chunk))),
+                tuple(chunk)
+            ):
+                google_id = event.google_id
+                export(event)
+                if event.google_id != google_id:
+                    exported.append((event.google_id, event.id))
+        finally:
+            if exported:
+                connection.executemany(
+                    'update events set google_id = ? where id = ?',
+                    exported
+                )
+                connection.commit()
+
+
+def import_events(events, progress=None, size=BATCH_SIZE, prune=(),
+                  export=None):
+    '''
+    Save events in batches inside a single transaction, so that an import of
+    any size only keeps one batch in memory and is either saved completely
+    or not at all. No notices are published, refresh the views afterwards.
+
+    Events are matched on their UID with the ones imported before, so
+    importing the same file twice adds nothing and writes only what
+    changed. Series leave out the occurrences that changed occurrences
+    replace.
+
+    :param events: Events
+    :type events: iterable
+
+    :param progress: Called with the number of events handled so far after
+        every batch
+    :type progress: callable
+
+    :param size: Number of events per batch
+    :type size: int
+
+    :param prune: Sources, e.g. paths of files, whose events that are not
+        part of this import anymore are deleted
+    :type prune: list[str]
+
+    :param export: Called with every event that is added or updated once
+        the import is committed, e.g. Google.export_event, see export_saved.
+        Unchanged events are not exported again.
+    :type export: callable
+
+    :returns Imported: Number of events added, updated, left alone and
+        deleted
+    '''
+    connection = Event.get_connection()
+    cursor = connection.cursor()
+    counts = dict.fromkeys(Imported._fields, 0)
+    count = 0
+    batch = []
+    # Events to export once the import is committed
+    saved = []
+    # Starts of the replaced occurrences per series UID
+    replaced = {}
+    try:
+        if prune:
+            cursor.execute('create temp table if not exists \
+                imported (uid text primary key)')
+            cursor.execute('delete from imported')
+        for event in events:
+            occurrence = get_replaced(event.uid)
+            if occurrence is not None:
+                replaced.setdefault(occurrence[0], []).append(occurrence[1])
+            batch.append(event)
+            if len(batch) == size:
+                ids = save_batch(batch, counts, bool(prune))
+                if export is not None:
+                    saved.extend(ids)
+                count = count + len(batch)
+                batch = []
+                if progress is not None:
+                    progress(count)
+        if batch:
+            ids = save_batch(batch, counts, bool(prune))
+            if export is not None:
+                saved.extend(ids)
+            count = count + len(batch)
+        Event.exclude_starts('uid', replaced, commit=False)
+        if prune:
+            cursor.execute(
+                'delete from events where source in ({}) \
+                    and uid is not null \
+                    and uid not in (select uid from imported)'.format(
+                    ', '.join('?' * len(prune))
+                ),
+                tuple(prune)
+            )
+            counts['deleted'] = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    if export is not None:
+        export_saved(saved, export)
+    if progress is not None:
+        progress(count)
+    return Imported(**counts)
+
+
+def import_file(path, progress=None, export=None, prune=False):
+    '''
+    Import the events of an iCalendar file, see import_events
+
+    :param path: Path to the file
+    :type path: str
+
+    :param progress: Called with the number of events saved so far and the
+        fraction of the file that has been read
+    :type progress: callable
+
+    :param export: Called with every event that is added or updated, see
+        import_events
+    :type export: callable
+
+    :param prune: Whether to delete the events an earlier import of the file
+        added that are not in it anymore
+    :type prune: bool
+
+    :returns Imported: Number of events added, updated, left alone and
+        deleted
+    '''
+    source = os.path.abspath(path)
+    with open(path) as ics_file:
+        total = max(os.fstat(ics_file.fileno()).st_size, 1)
+        events = read_events(ics_file, source)
+        def report(count):
+            progress(count, min(ics_file.tell() / float(total), 1.0))
+
+        return import_events(
+            events,
+            report if progress is not None else None,
+            prune=[source] if prune else [],
+            export=export
+        )
+
+
+def find_files(paths):
+    '''
+    Expand directories to the iCalendar files in them
+
+    :param paths: Paths to files and directories
+    :type paths: list[str]
+
+    :returns list[str]: Paths to files
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.lower().endswith(('.ics', '.ical'))
+            ))
+        else:
+            files.append(path)
+    return files
+
+
+def parse_file(path):
+    '''
+    Read all events of an iCalendar file, run by the processes of
+    parse_files
+
+    :param path: Path to the file
+    :type path: str
+
+    :returns tuple: Path, list of unsaved Events and seconds it took
+    '''
+    began = time.time()
+    with open(path) as ics_file:
+        events = list(read_events(ics_file, os.path.abspath(path)))
+    return path, events, time.time() - began
+
+
+def parse_files(paths, processes=None):
+    '''
+    Read the events of several files in a pool of processes, one file per
+    process at a time
+
+    :param paths: Paths to files
+    :type paths: list[str]
+
+    :param processes: Number of processes, one per core if not given
+    :type processes: int
+
+    :returns generator: Tuples from parse_file, in the order the files are
+        done
+    '''
+    pool = multiprocessing.Pool(processes)
+    try:
+        for parsed in pool.imap_unordered(parse_file, paths):
+            yield parsed
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def import_files(paths, processes=None, parsed=None, prune=False):
+    '''
+    Import several iCalendar files or directories of them. The files are
+    parsed in parallel and all events are saved by this process in a
+    single transaction, see import_events.
+
+    :param paths: Paths to files and directories
+    :type paths: list[str]
+
+    :param processes: Number of processes, one per core if not given
+    :type processes: int
+
+    :param parsed: Called with the path, the number of events and the
+        seconds it took to parse every file
+    :type parsed: callable
+
+    :param prune: Whether to delete the events earlier imports of the files
+        added that are not in them anymore
+    :type prune: bool
+
+    :returns Imported: Number of events added, updated, left alone and
+        deleted
+    '''
+    files = find_files(paths)
+
+    def read():
+        for path, events, seconds in parse_files(files, processes):
+            if parsed is not None:
+                parsed(path, len(events), seconds)
+            for event in events:
+                yield event
+    sources = [os.path.abspath(path) for path in files] if prune else []
+    return import_events(read(), prune=sources)
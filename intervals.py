@@ -0,0 +1,128 @@
+'''
+Module with an index over intervals for fast overlap queries
+'''
+from bisect import bisect_left, bisect_right
+
+
+class IntervalIndex(object):
+    '''
+    Static index over half-open intervals [start, end). Both overlap and
+    point queries take O(log n + k) time for k results. Bounds can be of
+    any comparable type, e.g. ints or datetimes.
+    '''
+    def __init__(self, intervals):
+        '''
+        Creates an IntervalIndex
+
+        :param intervals: Tuples of start, end and the item to return
+        :type intervals: list[tuple]
+        '''
+        intervals = sorted(intervals, key=lambda interval: interval[0])
+        self.starts = [interval[0] for interval in intervals]
+        self.items = [interval[2] for interval in intervals]
+        self.root = self._build(intervals)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _build(self, intervals):
+        '''
+        Build a centered interval tree. Every node keeps the intervals that
+        contain its center, sorted by start and by end, intervals entirely
+        before or after the center go to the left or right child.
+
+        :param intervals: Intervals
+        :type intervals: list[tuple]
+
+        :returns tuple|None: Node as (center, by_start, by_end, left, right)
+        '''
+        if not intervals:
+            return None
+        endpoints = sorted(
+            [interval[0] for interval in intervals] +
+            [interval[1] for interval in intervals]
+        )
+        # The lower median guarantees that both children get smaller
+        center = endpoints[(len(endpoints) - 1) // 2]
+        left = []
+        right = []
+        here = []
+        for interval in intervals:
+            if interval[1] <= center and interval[0] < center:
+                left.append(interval)
+            elif interval[0] > center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        by_start = sorted(here, key=lambda interval: interval[0])
+        by_end = sorted(here, key=lambda interval: interval[1], reverse=True)
+        return (
+            center,
+            by_start,
+            by_end,
+            self._build(left),
+            self._build(right),
+        )
+
+    def at(self, point):
+        '''
+        Get the items whose interval contains a point
+
+        :param point: Point
+        :type point: comparable
+
+        :returns list: Items
+        '''
+        found = []
+        node = self.root
+        while node is not None:
+            center, by_start, by_end, left, right = node
+            if point < center:
+                for start, end, item in by_start:
+                    if start > point:
+                        break
+                    found.append(item)
+                node = left
+            else:
+                for start, end, item in by_end:
+                    if end <= point:
+                        break
+                    found.append(item)
+                node = right
+        return found
+
+    def starting(self, start, end):
+        '''
+        Get the items whose interval starts in [start, end), ordered by start
+
+        :param start: Start, inclusive
+        :type start: comparable
+
+        :param end: End, exclusive
+        :type end: comparable
+
+        :returns list: Items
+        '''
+        first = bisect_left(self.starts, start)
+        last = bisect_left(self.starts, end)
+        return self.items[first:last]
+
+    def overlapping(self, start, end):
+        '''
+        Get the items whose interval overlaps [start, end)
+
+        :param start: Start, inclusive
+        :type start: comparable
+
+        :param end: End, exclusive
+        :type end: comparable
+
+        :returns list: Items
+        '''
+        if not start < end:
+            return []
+        # Intervals running at the start plus the ones starting after it
+        found = self.at(start)
+        first = bisect_right(self.starts, start)
+        last = bisect_left(self.starts, end)
+        return found + self.items[first:last]
@@ -0,0 +1,265 @@
+'''
+Module for measuring where the time goes while the calendar runs. Hot paths
+are wrapped in named spans and every SQL statement is counted and timed
+against the span it ran in. Nothing is recorded until enable is called, see
+the --profile option of cal.py.
+'''
+from functools import wraps
+
+import threading
+import sqlite3
+import time
+import sys
+
+
+# Name that statements outside of any span are reported under
+OUTSIDE = '(outside spans)'
+
+
+class Phase(object):
+    '''
+    Times recorded for one span name
+    '''
+    def __init__(self):
+        '''
+        Creates an empty Phase
+        '''
+        self.calls = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def add(self, seconds):
+        '''
+        Record a run of the span
+
+        :param seconds: Time the run took
+        :type seconds: float
+        '''
+        self.calls = self.calls + 1
+        self.seconds = self.seconds + seconds
+        self.slowest = max(self.slowest, seconds)
+
+    def add_query(self, seconds):
+        '''
+        Record a statement that ran inside the span
+
+        :param seconds: Time the statement took
+        :type seconds: float
+        '''
+        self.queries = self.queries + 1
+        self.query_seconds = self.query_seconds + seconds
+
+
+class Profiler(object):
+    '''
+    State of the instrumentation, shared by all threads
+    '''
+    enabled = False
+    started = None
+    lock = threading.Lock()
+    local = threading.local()
+    phases = {}
+    profile = None
+    dump_path = None
+
+    @staticmethod
+    def enable(dump_path=None):
+        '''
+        Start recording spans and statements
+
+        :param dump_path: Also run cProfile on the main thread and write its
+            stats here on report
+        :type dump_path: str
+        '''
+        Profiler.enabled = True
+        Profiler.started = time.time()
+        Profiler.phases = {}
+        Profiler.dump_path = dump_path
+        if dump_path is not None:
+            import cProfile
+            Profiler.profile = cProfile.Profile()
+            Profiler.profile.enable()
+
+    @staticmethod
+    def get_phase(name):
+        '''
+        Get the Phase of a span name, call with the lock held
+
+        :param name: Name of the span
+        :type name: str
+
+        :returns Phase: Phase
+        '''
+        if name not in Profiler.phases:
+            Profiler.phases[name] = Phase()
+        return Profiler.phases[name]
+
+    @staticmethod
+    def get_stack():
+        '''
+        Get the names of the spans the current thread is in
+
+        :returns list[str]: Names, innermost last
+        '''
+        if not hasattr(Profiler.local, 'stack'):
+            Profiler.local.stack = []
+        return Profiler.local.stack
+
+    @staticmethod
+    def add(name, seconds):
+        '''
+        Record a run of a span that was timed elsewhere
+
+        :param name: Name of the span
+        :type name: str
+
+        :param seconds: Time the run took
+        :type seconds: float
+        '''
+        with Profiler.lock:
+            Profiler.get_phase(name).add(seconds)
+
+    @staticmethod
+    def add_query(seconds):
+        '''
+        Record a statement against the innermost span of the current thread
+
+        :param seconds: Time the statement took
+        :type seconds: float
+        '''
+        stack = Profiler.get_stack()
+        name = stack[-1] if stack else OUTSIDE
+        with Profiler.lock:
+            Profiler.get_phase(name).add_query(seconds)
+
+    @staticmethod
+    def report(out=None):
+        '''
+        Write a table with the calls, time and statements per span and the
+        cProfile stats if enable was given a path
+
+        :param out: File to write the table to, stderr if not given
+        :type out: file
+        '''
+        if not Profiler.enabled:
+            return
+        out = out or sys.stderr
+        if Profiler.profile is not None:
+            Profiler.profile.disable()
+            Profiler.profile.dump_stats(Profiler.dump_path)
+        with Profiler.lock:
+            phases = sorted(
+                Profiler.phases.items(),
+                key=lambda item: item[1].seconds,
+                reverse=True
+            )
+        out.write('{:<28} {:>6} {:>10} {:>9} {:>9} {:>8} {:>9}\n'.format(
+            'span', 'calls', 'total ms', 'mean ms', 'max ms', 'queries',
+            'sql ms'
+        ))
+        for name, phase in phases:
+            out.write(
+                '{:<28} {:>6} {:>10.1f} {:>9.2f} {:>9.2f} {:>8} {:>9.1f}\n'
+                .format(
+                    name,
+                    phase.calls,
+                    phase.seconds * 1000,
+                    phase.seconds * 1000 / max(phase.calls, 1),
+                    phase.slowest * 1000,
+                    phase.queries,
+                    phase.query_seconds * 1000
+                )
+            )
+        out.write('{} statements in {:.1f}ms, ran for {:.1f}s\n'.format(
+            sum(phase.queries for name, phase in phases),
+            sum(phase.query_seconds for name, phase in phases) * 1000,
+            time.time() - Profiler.started
+        ))
+        if Profiler.profile is not None:
+            out.write('cProfile stats written to {}\n'.format(
+                Profiler.dump_path
+            ))
+
+
+class span(object):
+    '''
+    Time a block, or every call of a function when used as a decorator:
+
+        with span('FlexView.set_year'):
+            ...
+
+        @span('WeekView.add_days')
+        def add_days(self):
+            ...
+
+    Costs a single check when profiling is off.
+    '''
+    def __init__(self, name):
+        '''
+        :param name: Name the time is reported under
+        :type name: str
+        '''
+        self.name = name
+        self.began = None
+
+    def __enter__(self):
+        if Profiler.enabled:
+            Profiler.get_stack().append(self.name)
+            self.began = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.began is not None:
+            Profiler.add(self.name, time.time() - self.began)
+            Profiler.get_stack().pop()
+            self.began = None
+
+    def __call__(self, function):
+        name = self.name
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            if not Profiler.enabled:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        return timed
+
+
+class Cursor(sqlite3.Cursor):
+    '''
+    Cursor that records the time of its statements. Rows that are fetched
+    after the first one are not part of the time.
+    '''
+    def execute(self, *args):
+        began = time.time()
+        try:
+            return sqlite3.Cursor.execute(self, *args)
+        finally:
+            Profiler.add_query(time.time() - began)
+
+    def executemany(self, *args):
+        began = time.time()
+        try:
+            return sqlite3.Cursor.executemany(self, *args)
+        finally:
+            Profiler.add_query(time.time() - began)
+
+    def executescript(self, *args):
+        began = time.time()
+        try:
+            return sqlite3.Cursor.executescript(self, *args)
+        finally:
+            Profiler.add_query(time.time() - began)
+
+
+class Connection(sqlite3.Connection):
+    '''
+    Connection whose statements are recorded, pass it as the factory of
+    sqlite3.connect. Connection.execute goes through cursor, so its
+    statements are recorded as well.
+    '''
+    def cursor(self, factory=Cursor):
+        return sqlite3.Connection.cursor(self, factory)
@@ -0,0 +1,260 @@
+'''
+Module for expanding recurring events into occurrences
+'''
+from collections import OrderedDict
+from datetime import datetime
+
+import re
+
+
+# Format of the times in a rule
+FORMAT = '%Y%m%dT%H%M%S'
+
+
+def normalize(rule, from_utc=None):
+    '''
+    Prepare a recurrence rule for storage. Event times are stored without a
+    timezone, so times given in UTC, like in UNTIL=20161231T000000Z, are made
+    floating as well. EXDATE lines lose their TZID and VALUE, their times are
+    expected in the local time of the start.
+
+    :param rule: Rule, e.g. RRULE:FREQ=WEEKLY;UNTIL=20161231T000000Z
+    :type rule: str
+
+    :param from_utc: Converts a time in UTC to the local time the start of
+        the event was stored in, only the Z is dropped if not given
+    :type from_utc: callable
+
+    :returns str|None: Rule, None if it is empty
+    '''
+    if not rule:
+        return None
+
+    def to_floating(match):
+        if from_utc is None:
+            return match.group(1)
+        moment = datetime.strptime(match.group(1), FORMAT)
+        return from_utc(moment).strftime(FORMAT)
+    lines = []
+    for line in rule.strip().splitlines():
+        name, __, value = line.partition(':')
+        if name.upper().startswith('EXDATE'):
+            line = 'EXDATE:' + value
+        lines.append(re.sub(r'(\d{8}T\d{6})Z', to_floating, line))
+    return '\n'.join(lines)
+
+
+def canonical(rule, replaced=()):
+    '''
+    Write a rule the way importer.to_event does, with all of its EXDATE
+    values on one line, to compare it with an imported one
+
+    :param rule: Rule, see normalize
+    :type rule: str
+
+    :param replaced: Starts to leave out of EXDATE, formatted as in a rule
+    :type replaced: set[str]
+
+    :returns str: Rule
+    '''
+    lines = []
+    excluded = set()
+    for line in rule.splitlines():
+        name, __, value = line.partition(':')
+        if name.upper() == 'EXDATE':
+            excluded.update(value.split(','))
+        else:
+            lines.append(line)
+    excluded = excluded - set(replaced)
+    if excluded:
+        lines.append('EXDATE:' + ','.join(sorted(excluded)))
+    return '\n'.join(lines)
+
+
+def exclude(rule, starts):
+    '''
+    Leave some occurrences out of a series by adding them to its EXDATE
+
+    :param rule: Rule, see normalize
+    :type rule: str
+
+    :param starts: Starts of the occurrences to leave out
+    :type starts: list[datetime]
+
+    :returns str: Rule
+    '''
+    lines = rule.splitlines()
+    excluded = set()
+    for line in lines:
+        name, __, value = line.partition(':')
+        if name.upper() == 'EXDATE':
+            excluded.update(value.split(','))
+    values = set(start.strftime(FORMAT) for start in starts) - excluded
+    if not values:
+        return rule
+    return '\n'.join(lines + ['EXDATE:' + ','.join(sorted(values))])
+
+
+def shift(rule, delta):
+    '''
+    Move the times in a rule along with the start of its series, so that
+    UNTIL and EXDATE keep pointing at the same occurrences
+
+    :param rule: Rule, see normalize
+    :type rule: str
+
+    :param delta: How far the start of the series moves
+    :type delta: timedelta
+
+    :returns str: Rule
+    '''
+    def move(match):
+        moment = datetime.strptime(match.group(2), FORMAT) + delta
+        return match.group(1) + moment.strftime(FORMAT)
+
+    def move_date(match):
+        moment = datetime.strptime(match.group(2), '%Y%m%d') + delta
+        return match.group(1) + moment.strftime('%Y%m%d')
+    lines = []
+    for line in rule.splitlines():
+        name, __, value = line.partition(':')
+        if name.upper() == 'EXDATE':
+            line = name + ':' + re.sub(r'()(\d{8}T\d{6})', move, value)
+        else:
+            line = re.sub(r'(UNTIL=)(\d{8}T\d{6})', move, line)
+            line = re.sub(r'(UNTIL=)(\d{8})(?!\d|T)', move_date, line)
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def is_bounded(rule):
+    '''
+    Check whether a series ends, because every rule in it has a COUNT or an
+    UNTIL
+
+    :param rule: Rule, see normalize
+    :type rule: str
+
+    :returns bool: True if the series ends
+    '''
+    for line in rule.upper().splitlines():
+        name = line.split(':', 1)[0].split(';', 1)[0] if ':' in line else ''
+        if name in ('EXDATE', 'RDATE', 'EXRULE', 'DTSTART'):
+            continue
+        if 'COUNT=' not in line and 'UNTIL=' not in line:
+            return False
+    return True
+
+
+def get_last_start(rule, start):
+    '''
+    Get the start of the last occurrence of a series
+
+    :param rule: Rule, see normalize
+    :type rule: str
+
+    :param start: Start of the first occurrence
+    :type start: datetime
+
+    :returns datetime|None: Start of the last occurrence, None if the series
+        does not end
+    '''
+    if not is_bounded(rule):
+        return None
+    # Imported on first use to keep dateutil off the startup path
+    from dateutil.rrule import rrulestr
+
+    last = start
+    for moment in rrulestr(rule, dtstart=start, forceset=True):
+        last = moment
+    return last
+
+
+class RecurrenceCache(object):
+    '''
+    Memoizes the parsed recurrence rules and their expansion per window, so
+    that views asking for the same week or year again do not expand the
+    rules again and other windows do not parse them again.
+    '''
+    MAX_WINDOWS = 500
+    MAX_RULES = 1000
+
+    def __init__(self):
+        '''
+        Creates an empty RecurrenceCache
+        '''
+        self.hits = 0
+        self.misses = 0
+        self.windows = OrderedDict()
+        self.rules = OrderedDict()
+
+    def clear(self):
+        '''
+        Remove all expansions
+        '''
+        self.windows = OrderedDict()
+        self.rules = OrderedDict()
+
+    def get_rule(self, rule, start):
+        '''
+        Get a parsed series. It remembers the occurrences it has generated,
+        so later windows only generate the ones after them.
+
+        :param rule: Recurrence rule
+        :type rule: str
+
+        :param start: Start of the first occurrence
+        :type start: datetime
+
+        :returns dateutil.rrule.rrulebase: Series
+        '''
+        key = (rule, start)
+        if key in self.rules:
+            parsed = self.rules.pop(key)
+            self.rules[key] = parsed
+            return parsed
+        # Imported on first use to keep dateutil off the startup path
+        from dateutil.rrule import rrulestr
+
+        parsed = rrulestr(rule, dtstart=start, cache=True)
+        self.rules[key] = parsed
+        while len(self.rules) > self.MAX_RULES:
+            self.rules.popitem(last=False)
+        return parsed
+
+    def get_starts(self, rule, start, window_start, window_end):
+        '''
+        Get the start of every occurrence of a series in a window
+
+        :param rule: Recurrence rule
+        :type rule: str
+
+        :param start: Start of the first occurrence
+        :type start: datetime
+
+        :param window_start: Start of the window, inclusive
+        :type window_start: datetime
+
+        :param window_end: End of the window, exclusive
+        :type window_end: datetime
+
+        :returns list[datetime]: Starts of the occurrences
+        '''
+        key = (rule, start, window_start, window_end)
+        if key in self.windows:
+            self.hits = self.hits + 1
+            starts = self.windows.pop(key)
+            self.windows[key] = starts
+            return starts
+        self.misses = self.misses + 1
+        starts = [
+            moment for moment in self.get_rule(rule, start).between(
+                window_start,
+                window_end,
+                inc=True
+            ) if moment < window_end
+        ]
+        self.windows[key] = starts
+        while len(self.windows) > self.MAX_WINDOWS:
+            self.windows.popitem(last=False)
+        return starts
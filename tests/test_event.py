@@ -0,0 +1,101 @@
+'''
+Checks changing recurring events
+
+    python -m unittest discover tests
+'''
+from datetime import date, datetime, timedelta
+
+import tempfile
+import unittest
+import shutil
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from event import Event
+
+import recurrence
+import importer
+import exporter
+
+
+class SeriesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        Event.CONFIG_DIR = self.directory
+        Event.connect()
+        self.series = Event()
+        self.series.name = 'Standup'
+        self.series.set_start(datetime(2016, 1, 4, 9))
+        self.series.set_end(datetime(2016, 1, 4, 10))
+        self.series.set_rrule(
+            'RRULE:FREQ=DAILY;UNTIL=20160108T090000\n'
+            'EXDATE:20160106T090000'
+        )
+        self.series.save()
+
+    def tearDown(self):
+        Event.get_connection().close()
+        Event.is_connected = False
+        shutil.rmtree(self.directory)
+
+    def get_starts(self):
+        '''
+        Get the starts of the events in the week of the series
+
+        :returns list[datetime]: Starts
+        '''
+        days = Event.get_range(date(2016, 1, 4), date(2016, 1, 10))
+        return sorted(
+            event.get_start() for events in days.values() for event in events
+        )
+
+    def test_split(self):
+        occurrence = Event.get_by_day(2016, 1, 5)[0]
+        series, event = occurrence.split()
+        event.start_hour = 11
+        event.end_hour = 12
+        Event.save_many([series, event])
+        self.assertEqual(self.get_starts(), [
+            datetime(2016, 1, 4, 9),
+            datetime(2016, 1, 5, 11),
+            datetime(2016, 1, 7, 9),
+            datetime(2016, 1, 8, 9),
+        ])
+        self.assertEqual(event.rrule, None)
+        self.assertEqual(event.uid, series.uid + '#' + exporter.to_utc(
+            datetime(2016, 1, 5, 9)
+        ).strftime(recurrence.FORMAT + 'Z'))
+
+        # The occurrence is exported as a changed occurrence of the series
+        path = os.path.join(self.directory, 'calendar.ics')
+        exporter.export_file(path)
+        self.assertIn('RECURRENCE-ID', open(path).read())
+        imported = importer.import_file(path)
+        self.assertEqual((imported.added, imported.updated), (0, 0))
+
+    def test_shift(self):
+        occurrence = Event.get_by_day(2016, 1, 5)[0]
+        occurrence.date = date(2016, 1, 6)
+        delta = occurrence.get_start() - datetime(2016, 1, 5, 9)
+        occurrence.rrule = recurrence.shift(occurrence.rrule, delta)
+        occurrence.save()
+        self.assertEqual(self.get_starts(), [
+            datetime(2016, 1, 5, 9),
+            datetime(2016, 1, 6, 9),
+            datetime(2016, 1, 8, 9),
+            datetime(2016, 1, 9, 9),
+        ])
+
+    def test_shift_date(self):
+        rule = 'RRULE:FREQ=DAILY;UNTIL=20160108'
+        self.assertEqual(
+            recurrence.shift(rule, timedelta(2)),
+            'RRULE:FREQ=DAILY;UNTIL=20160110'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+'''
+Checks exporting events to iCalendar files
+
+    python -m unittest discover tests
+'''
+from datetime import datetime
+
+import tempfile
+import unittest
+import shutil
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from test_importer import write_calendar
+from event import Event
+
+import importer
+import exporter
+
+
+class ExporterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        Event.CONFIG_DIR = self.directory
+        Event.connect()
+
+    def tearDown(self):
+        Event.get_connection().close()
+        Event.is_connected = False
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        event = Event()
+        event.name = 'Lunch'
+        event.location = u'Caf\xe9'
+        event.set_start(datetime(2016, 1, 4, 12))
+        event.set_end(datetime(2016, 1, 4, 13))
+        event.save()
+        series = Event()
+        series.name = 'Gym'
+        series.set_start(datetime(2016, 1, 4, 18))
+        series.set_end(datetime(2016, 1, 4, 19))
+        series.set_rrule('RRULE:FREQ=WEEKLY;COUNT=4')
+        series.save()
+        path = os.path.join(self.directory, 'calendar.ics')
+        write_calendar(
+            path,
+            (
+                'UID:standup@test',
+                'SUMMARY:Standup',
+                'DTSTART:20160104T090000',
+                'DTEND:20160104T093000',
+                'RRULE:FREQ=DAILY;UNTIL=20160110T090000',
+                'EXDATE:20160107T090000',
+            ),
+            (
+                'UID:standup@test',
+                'SUMMARY:Standup moved',
+                'RECURRENCE-ID:20160105T090000',
+                'DTSTART:20160105T110000',
+                'DTEND:20160105T113000',
+            ),
+        )
+        importer.import_file(path)
+
+        exported = os.path.join(self.directory, 'exported.ics')
+        self.assertEqual(exporter.export_file(exported), 4)
+        imported = importer.import_file(exported)
+        self.assertEqual(
+            (imported.added, imported.updated, imported.unchanged),
+            (0, 0, 4)
+        )
+        # Exporting again writes the same events
+        again = os.path.join(self.directory, 'again.ics')
+        exporter.export_file(again)
+        self.assertEqual(
+            [line for line in open(exported) if 'DTSTAMP' not in line],
+            [line for line in open(again) if 'DTSTAMP' not in line]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
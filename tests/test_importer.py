@@ -0,0 +1,158 @@
+'''
+Checks importing iCalendar files
+
+    python -m unittest discover tests
+'''
+from datetime import date
+
+import tempfile
+import unittest
+import sqlite3
+import shutil
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from event import Event
+
+import importer
+
+
+def write_calendar(path, *events):
+    '''
+    Write an iCalendar file
+
+    :param path: Path of the file
+    :type path: str
+
+    :param events: Lines of every VEVENT, without BEGIN and END
+    :type events: list[str]
+    '''
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0']
+    for event in events:
+        lines = lines + ['BEGIN:VEVENT'] + list(event) + ['END:VEVENT']
+    lines.append('END:VCALENDAR')
+    with open(path, 'w') as ics_file:
+        ics_file.write('\r\n'.join(lines) + '\r\n')
+
+
+class ImporterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'calendar.ics')
+        Event.CONFIG_DIR = self.directory
+        Event.connect()
+
+    def tearDown(self):
+        Event.get_connection().close()
+        Event.is_connected = False
+        shutil.rmtree(self.directory)
+
+    def get_names(self, day):
+        '''
+        Get the names of the events on a day
+
+        :param day: Day
+        :type day: date
+
+        :returns list[str]: Names
+        '''
+        return [
+            event.name
+            for event in Event.get_by_day(day.year, day.month, day.day)
+        ]
+
+    def test_override_of_non_ascii_series(self):
+        write_calendar(
+            self.path,
+            (
+                'UID:standup@test',
+                'SUMMARY:Standup',
+                u'LOCATION:Caf\xe9'.encode('utf-8'),
+                'DTSTART:20160104T090000',
+                'DTEND:20160104T093000',
+                'RRULE:FREQ=DAILY;COUNT=3',
+            ),
+            (
+                'UID:standup@test',
+                'SUMMARY:Standup moved',
+                'RECURRENCE-ID:20160105T090000',
+                'DTSTART:20160105T110000',
+                'DTEND:20160105T113000',
+            ),
+        )
+        imported = importer.import_file(self.path)
+        self.assertEqual((imported.added, imported.updated), (2, 0))
+        self.assertEqual(self.get_names(date(2016, 1, 4)), ['Standup'])
+        self.assertEqual(self.get_names(date(2016, 1, 5)), ['Standup moved'])
+        series = Event.get_by_day(2016, 1, 6)[0]
+        self.assertEqual(series.location, u'Caf\xe9'.encode('utf-8'))
+
+        imported = importer.import_file(self.path)
+        self.assertEqual((imported.added, imported.updated), (0, 0))
+        self.assertEqual(self.get_names(date(2016, 1, 5)), ['Standup moved'])
+
+    def test_export_after_commit(self):
+        exported = []
+
+        def export(event):
+            # Another connection can write, so the import is committed
+            other = sqlite3.connect(
+                os.path.join(self.directory, 'events.db'),
+                timeout=0
+            )
+            other.execute('begin immediate')
+            other.rollback()
+            other.close()
+            exported.append((event.name, event.google_id))
+            if not event.google_id:
+                event.google_id = 'google-' + event.name
+
+        def write(name):
+            write_calendar(
+                self.path,
+                (
+                    'UID:a@test',
+                    'SUMMARY:A',
+                    'DTSTART:20160104T090000',
+                    'DTEND:20160104T100000',
+                ),
+                (
+                    'UID:b@test',
+                    'SUMMARY:' + name,
+                    'DTSTART:20160105T090000',
+                    'DTEND:20160105T100000',
+                ),
+            )
+
+        def run():
+            # One event per batch, so that the second one is exported
+            # after the first one was written
+            with open(self.path) as ics_file:
+                importer.import_events(
+                    importer.read_events(ics_file, self.path),
+                    size=1,
+                    export=export
+                )
+
+        write('B')
+        run()
+        self.assertEqual(sorted(exported), [('A', ''), ('B', '')])
+
+        del exported[:]
+        run()
+        self.assertEqual(exported, [])
+
+        write('C')
+        run()
+        self.assertEqual(exported, [('C', 'google-B')])
+        self.assertEqual(
+            sorted(event.google_id for event in Event.get_all()),
+            ['google-A', 'google-B']
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
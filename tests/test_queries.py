@@ -0,0 +1,129 @@
+'''
+Checks that the lookups of the views run a fixed number of statements, no
+matter how many events there are. The statements are counted through the
+profiler.
+
+    python -m unittest discover tests
+'''
+from datetime import date, datetime, timedelta
+
+import tempfile
+import unittest
+import shutil
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from profiler import Profiler, span
+from event import Event
+
+
+# Day most of the events are put on
+DAY = date(2016, 3, 1)
+
+
+def make_event(i):
+    '''
+    Create an event on DAY or the day after it. One in ten repeats daily.
+
+    :param i: Number of the event
+    :type i: int
+
+    :returns Event: Unsaved Event
+    '''
+    start = datetime(DAY.year, DAY.month, DAY.day, i % 20) + \
+        timedelta(i % 2)
+    event = Event()
+    event.name = 'Event {}'.format(i)
+    event.set_start(start)
+    event.set_end(start + timedelta(hours=1))
+    if i % 10 == 0:
+        event.set_rrule('RRULE:FREQ=DAILY;COUNT=5')
+    return event
+
+
+class QueryCountTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # Connections only count their statements when opened while
+        # profiling
+        Profiler.enable()
+        Event.CONFIG_DIR = self.directory
+        Event.connect()
+
+    def tearDown(self):
+        Event.get_connection().close()
+        Event.is_connected = False
+        Profiler.enabled = False
+        shutil.rmtree(self.directory)
+
+    def count_queries(self, function, *args):
+        '''
+        Count the statements a cold lookup runs
+
+        :param function: Lookup, e.g. Event.get_by_day
+        :type function: callable
+
+        :returns int: Number of statements
+        '''
+        Event.cache.clear()
+        Event.recurrences.clear()
+        name = 'test.' + function.__name__
+        with span(name):
+            function(*args)
+        phase = Profiler.phases.pop(name)
+        return phase.queries
+
+    def count_all(self):
+        '''
+        Count the statements of every lookup
+
+        :returns dict[str, int]: Number of statements per lookup
+        '''
+        return {
+            'get_by_day': self.count_queries(
+                Event.get_by_day,
+                DAY.year,
+                DAY.month,
+                DAY.day
+            ),
+            'get_by_hour': self.count_queries(
+                Event.get_by_hour,
+                DAY.year,
+                DAY.month,
+                DAY.day,
+                9
+            ),
+            'get_all': self.count_queries(Event.get_all),
+            'get_range': self.count_queries(
+                Event.get_range,
+                DAY - timedelta(3),
+                DAY + timedelta(3)
+            ),
+        }
+
+    def test_constant_queries(self):
+        Event.save_many([make_event(i) for i in range(10)])
+        few = self.count_all()
+        Event.save_many([make_event(i) for i in range(10, 1000)])
+        many = self.count_all()
+        self.assertEqual(few, many)
+        for name, count in many.items():
+            self.assertLessEqual(count, 4, name)
+
+    def test_results(self):
+        Event.save_many([make_event(i) for i in range(100)])
+        # Half of the events start on the day, including every series
+        events = Event.get_by_day(DAY.year, DAY.month, DAY.day)
+        self.assertEqual(len(events), 50)
+        days = Event.get_range(DAY, DAY + timedelta(1))
+        self.assertEqual(len(days[DAY]), 50)
+        # The others start the day after, with an occurrence of every series
+        self.assertEqual(len(days[DAY + timedelta(1)]), 50 + 10)
+        self.assertEqual(len(Event.get_all()), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+'''
+Checks that the slow optional dependencies stay off the startup path of the
+window and the command line, see benchmarks/startup.py for the timings
+
+    python -m unittest discover tests
+'''
+import subprocess
+import tempfile
+import unittest
+import shutil
+import json
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed for syncing, importing and exporting
+DEFERRED = (
+    'apiclient',
+    'oauth2client',
+    'httplib2',
+    'icalendar',
+    'dateutil',
+)
+
+LOADED = '''
+import json, sys
+print json.dumps(sorted(set(name.split('.')[0] for name in sys.modules)))
+'''
+
+
+def has_gtk():
+    '''
+    Check whether GTK can be imported, the window needs it
+
+    :returns bool: True if it can
+    '''
+    try:
+        from gi.repository import Gtk
+    except ImportError:
+        return False
+    return True
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.home)
+
+    def get_loaded(self, code):
+        '''
+        Run code in a fresh interpreter
+
+        :param code: Code
+        :type code: str
+
+        :returns list[str]: Top level modules loaded after running it
+        '''
+        environment = dict(os.environ, HOME=self.home)
+        output = subprocess.check_output(
+            [sys.executable, '-c', code + LOADED],
+            cwd=ROOT,
+            env=environment
+        )
+        return json.loads(output.splitlines()[-1])
+
+    def assertDeferred(self, loaded):
+        self.assertEqual(
+            [name for name in DEFERRED if name in loaded],
+            []
+        )
+
+    def test_cli(self):
+        self.assertDeferred(self.get_loaded(
+            'import cli\n'
+            "cli.main(['agenda'])\n"
+            "cli.main(['search', 'dentist'])\n"
+        ))
+
+    @unittest.skipUnless(has_gtk(), 'GTK is not installed')
+    def test_window(self):
+        self.assertDeferred(self.get_loaded('import cal\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+'''
+Module for running database work off the main thread
+'''
+from Queue import Queue
+from event import Event
+from profiler import span
+
+import threading
+import sys
+
+
+class Future(object):
+    '''
+    Result of a task that is run by a DatabaseWorker
+    '''
+    def __init__(self):
+        '''
+        Creates a pending Future
+        '''
+        self.finished = threading.Event()
+        self.value = None
+        self.error = None
+
+    def done(self):
+        '''
+        Check whether the task has run
+
+        :returns bool: True if the task has run
+        '''
+        return self.finished.is_set()
+
+    def set_result(self, value=None, error=None):
+        '''
+        Store the outcome of the task and wake up anyone waiting for it
+
+        :param value: Return value of the task
+        :type value: mixed
+
+        :param error: Exception info of the task, as from sys.exc_info
+        :type error: tuple
+        '''
+        self.value = value
+        self.error = error
+        self.finished.set()
+
+    def result(self, timeout=None):
+        '''
+        Wait for the task and return its value, raising the exception of the
+        task if it failed.
+
+        :param timeout: Seconds to wait, forever if not given
+        :type timeout: float
+
+        :returns mixed: Return value of the task
+        '''
+        if not self.finished.wait(timeout):
+            raise RuntimeError('Task did not finish in time')
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class DatabaseWorker(object):
+    '''
+    Thread that runs Event queries and saves in the order they are submitted,
+    so that the main thread never waits for the disk. Callbacks are handed to
+    a deliver function, pass GLib.idle_add to run them on the GTK main loop.
+    '''
+    def __init__(self, deliver=None):
+        '''
+        Creates a DatabaseWorker, call start to run it
+
+        :param deliver: Called as deliver(function, *args) to run a callback,
+            runs callbacks on the worker thread if not given
+        :type deliver: callable
+        '''
+        self.deliver = deliver
+        self.tasks = Queue()
+        self.thread = threading.Thread(target=self.run, name='database')
+        self.thread.daemon = True
+
+    def start(self):
+        '''
+        Start the thread
+        '''
+        self.thread.start()
+
+    def stop(self):
+        '''
+        Let the thread finish the submitted tasks and wait for it to end
+        '''
+        self.tasks.put(None)
+        self.thread.join()
+
+    def run(self):
+        '''
+        Run tasks until stopped
+        '''
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            function, args, callback, future = task
+            try:
+                with span('worker.' + function.__name__):
+                    future.set_result(function(*args))
+            except Exception:
+                future.set_result(error=sys.exc_info())
+            if callback is not None:
+                self._deliver(callback, future)
+
+    def _deliver(self, callback, future):
+        '''
+        Run a callback through the deliver function
+        '''
+        if self.deliver is None:
+            callback(future)
+            return
+        # GLib.idle_add repeats callbacks that return True
+        self.deliver(lambda: callback(future) and False)
+
+    def submit(self, function, args=(), callback=None):
+        '''
+        Run a function on the worker thread
+
+        :param function: Function, e.g. Event.get_range
+        :type function: callable
+
+        :param args: Arguments to call the function with
+        :type args: tuple
+
+        :param callback: Called with the Future once the function has run
+        :type callback: callable
+
+        :returns Future: Result of the function
+        '''
+        future = Future()
+        self.tasks.put((function, args, callback, future))
+        return future
+
+    def get_range(self, start_date, end_date, callback=None):
+        '''
+        Get the events starting in a range of days, see Event.get_range
+
+        :returns Future: Dict of date to list[Event]
+        '''
+        return self.submit(Event.get_range, (start_date, end_date), callback)
+
+    def get_by_day(self, day, callback=None):
+        '''
+        Get the events starting on a day, see Event.get_by_day
+
+        :returns Future: list[Event]
+        '''
+        args = (day.year, day.month, day.day)
+        return self.submit(Event.get_by_day, args, callback)
+
+    def get_day_counts(self, start_date, end_date, callback=None):
+        '''
+        Count the events per day in a range, see Event.get_day_counts
+
+        :returns Future: Dict of date to int
+        '''
+        args = (start_date, end_date)
+        return self.submit(Event.get_day_counts, args, callback)
+
+    def search(self, query, limit, callback=None):
+        '''
+        Find events by name or location, see Event.search
+
+        :returns Future: list[Event]
+        '''
+        return self.submit(Event.search, (query, limit), callback)
+
+    def save(self, event, callback=None):
+        '''
+        Save an event, see Event.save
+
+        :returns Future: None
+        '''
+        return self.submit(event.save, (), callback)
+
+    def save_many(self, events, callback=None):
+        '''
+        Save events in one transaction, see Event.save_many
+
+        :returns Future: None
+        '''
+        return self.submit(Event.save_many, (events,), callback)
+
+    def delete(self, event, callback=None):
+        '''
+        Delete an event, see Event.delete
+
+        :returns Future: None
+        '''
+        return self.submit(event.delete, (), callback)